@@ -0,0 +1,83 @@
+"""This module runs a local stub of the CKAN datastore_search API
+serving synthetic datasets (see synthetic module), so the downloader
+module can be exercised without network access.
+
+    python -m benchmarks.ckan_stub --size 100000 --port 8765
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import threading
+from benchmarks import synthetic
+
+class CKANStub(ThreadingHTTPServer):
+    """Threaded http server answering /api/3/action/datastore_search
+    requests for the resources given as {resource_id: (name, size)}"""
+    
+    daemon_threads = True
+    
+    def __init__(self, resources:dict, port:int=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.resources = resources
+        self.bytes_sent = 0
+    
+    @property
+    def api_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/api/3/action/'
+    
+    def start(self) -> threading.Thread:
+        """Serves requests from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+class _Handler(BaseHTTPRequestHandler):
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        resource_id = query.get('resource_id', [''])[0]
+        if (not url.path.endswith('/datastore_search') 
+                or resource_id not in self.server.resources):
+            self.send_error(404)
+            return
+        
+        name, total = self.server.resources[resource_id]
+        limit = int(query.get('limit', ['100'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        result = {'resource_id': resource_id,
+                  'fields': [{'id': field} for field 
+                             in synthetic.FIELDS[name]],
+                  'records': synthetic.records(name, offset, limit, total),
+                  'total': total,
+                  'limit': limit,
+                  'offset': offset}
+        body = json.dumps({'success': True, 'result': result}).encode()
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes_sent += len(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def resources_for(datasets:list, size:int) -> dict:
+    """Maps each dataset resource id to (name, size)"""
+    return {dataset['resource_id']: (dataset['name'], size) 
+            for dataset in datasets}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    
+    resources = {name: (name, args.size) for name in synthetic.FIELDS}
+    server = CKANStub(resources, args.port)
+    print(f'Serving {list(resources)} at {server.api_url}')
+    server.serve_forever()
@@ -0,0 +1,173 @@
+"""End-to-end benchmark of the pipeline stages of script.py.
+
+Synthetic datasets of each size are served from a local CKAN stub and
+every stage is timed: api_to_df, df_to_csv, normalize, df_concat, 
+deduplicate, totales, cines and (with --db) df_to_dbtable. For each stage the wall 
+time, cpu time, rows, throughput and tracemalloc peak are saved to a 
+json file, so results of different versions can be compared.
+Stages run twice, once traced for the memory peak and once timed,
+as tracemalloc slows allocations down.
+
+Snapshots and metrics are written in a scratch folder, and logs to
+benchmarks.log in the system temporary folder (unless LOG_FILE is
+set), so the pipeline logs.log is left alone.
+
+    python -m benchmarks.run --sizes 10000 100000 1000000 --db
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+# Log file, opened when components are imported
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 
+                                               'benchmarks.log'))
+
+import components.downloader as dw
+import components.dataframe_processor as proc
+import components.dedup as dedup
+from benchmarks.ckan_stub import CKANStub, resources_for
+
+STAGES = ['api_to_df', 'df_to_csv', 'normalize', 'df_concat', 
+          'deduplicate', 'totales', 'cines', 'df_to_dbtable']
+
+def measure(results:list, stage:str, size:int, rows:int, 
+            func, *args, memory:bool=True, bytes_sent=None, **kwargs):
+    """Runs func(*args, **kwargs), appends its measures 
+    to results and returns its output. With memory set, func 
+    first runs under tracemalloc for the peak, and is timed on
+    a second run without it. bytes_sent (a callable) counts the
+    bytes downloaded by the timed run."""
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    
+    sent = bytes_sent() if bytes_sent else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    output = func(*args, **kwargs)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    results.append({'stage': stage,
+                    'size': size,
+                    'rows': rows,
+                    'wall_s': round(wall, 6),
+                    'cpu_s': round(cpu, 6),
+                    'rows_per_s': round(rows / wall, 1) if wall else None,
+                    'peak_bytes': peak})
+    if bytes_sent:
+        results[-1]['bytes_downloaded'] = bytes_sent() - sent
+    print(f'{size:>10} {stage:<14} {wall:>9.3f}s '
+          f'{(peak or 0) / 2**20:>9.1f} MiB')
+    return output
+
+def run_size(size:int, page_size:int, db:bool, memory:bool) -> list:
+    """Benchmarks every stage with datasets of size records each"""
+    results = []
+    server = CKANStub(resources_for(dw.DATASETS, size))
+    server.start()
+    dw.API_URL = server.api_url
+    try:
+        norm_list = []
+        raw_cines = None
+        for dataset in dw.DATASETS:
+            raw_df = measure(results, 'api_to_df', size, size, 
+                             dw.api_to_df, dataset, page_size=page_size, 
+                             memory=memory, 
+                             bytes_sent=lambda: server.bytes_sent)
+            measure(results, 'df_to_csv', size, size, 
+                    dw.df_to_csv, raw_df, dataset, memory=memory)
+            norm_list.append(measure(results, 'normalize', size, size, 
+                                     proc.normalize, raw_df, dataset, 
+                                     memory=memory))
+            if dataset['name'] == 'Salas de cine':
+                raw_cines = raw_df
+            del raw_df
+        
+        rows = sum(len(df) for df in norm_list)
+        sitios = measure(results, 'df_concat', size, rows, 
+                         proc.df_concat, norm_list, memory=memory)
+        del norm_list
+        sitios = measure(results, 'deduplicate', size, rows, 
+                         dedup.deduplicate, sitios, report_path='', 
+                         memory=memory)
+        totales = measure(results, 'totales', size, rows, 
+                          proc.totales, sitios, memory=memory)
+        cines = measure(results, 'cines', size, len(raw_cines), 
+                        proc.cines, raw_cines, memory=memory)
+        
+        if db:
+            import components.dbconnector as con
+            con.create_database()
+            for table, df in [('sitios', sitios), ('totales', totales), 
+                              ('cines', cines)]:
+                measure(results, 'df_to_dbtable', size, len(df), 
+                        con.df_to_dbtable, df, table=table, 
+                        memory=memory)
+            con.dispose()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, 
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, 
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', 
+                        default=[10000, 100000],
+                        help='records per dataset (10k to 10M)')
+    parser.add_argument('--page-size', type=int, default=dw.PAGE_SIZE)
+    parser.add_argument('--db', action='store_true',
+                        help='also benchmark df_to_dbtable (PostgreSQL)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace memory (runs stages once)')
+    parser.add_argument('--output', default=None,
+                        help='results json path')
+    args = parser.parse_args()
+    
+    started = datetime.datetime.now()
+    output = os.path.abspath(args.output or os.path.join(
+        'benchmarks', f'results-{started:%Y%m%d-%H%M%S}.json'))
+    revision = _git_revision()
+    
+    # Snapshots and metrics are written in a scratch folder
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for size in args.sizes:
+                results += run_size(size, args.page_size, args.db, 
+                                    not args.no_memory)
+        finally:
+            os.chdir(cwd)
+    
+    report = {'started': started.isoformat(),
+              'revision': revision,
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'page_size': args.page_size,
+              'results': results}
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Results saved to {output}')
@@ -0,0 +1,110 @@
+"""This module generates synthetic records with the shape of the
+three datos.gob.ar datasets (museums, cinemas and popular libraries).
+Records are generated by page, so any offset of a dataset of any
+size can be produced without building the whole dataset"""
+
+import numpy as np
+
+PROVINCIAS = ['Buenos Aires', 'Ciudad Autónoma de Buenos Aires', 
+              'Catamarca', 'Chaco', 'Chubut', 'Córdoba', 'Corrientes', 
+              'Entre Ríos', 'Formosa', 'Jujuy', 'La Pampa', 'La Rioja', 
+              'Mendoza', 'Misiones', 'Neuquén', 'Río Negro', 'Salta', 
+              'San Juan', 'San Luis', 'Santa Cruz', 'Santa Fe', 
+              'Santiago del Estero', 'Tierra del Fuego', 'Tucumán']
+
+NULL_MARKERS = ['s/d', '', ' ', '"']
+
+# CKAN field ids of each dataset, in source order
+FIELDS = {
+    'Museos': ['_id', 'Localidad_ID', 'Provincia_ID', 'categoria', 
+               'provincia', 'localidad', 'nombre', 'direccion', 
+               'codigo_postal', 'telefono', 'mail', 'web', 'fuente'],
+    'Salas de cine': ['_id', 'Cod_Loc', 'IdProvincia', 'IdDepartamento', 
+                      'Provincia', 'Localidad', 'Nombre', 'Direccion', 
+                      'CP', 'Teléfono', 'Mail', 'Web', 'Fuente', 
+                      'Pantallas', 'Butacas', 'espacio_INCAA'],
+    'Bibliotecas populares': ['_id', 'Cod_Loc', 'IdProvincia', 
+                              'IdDepartamento', 'Provincia', 'Localidad', 
+                              'Nombre', 'Domicilio', 'CP', 'Teléfono', 
+                              'Mail', 'Web', 'Fuente']
+    }
+
+def _with_nulls(rng, values:np.ndarray, rate:float=0.05) -> np.ndarray:
+    """Replaces a fraction of values with null markers"""
+    values = values.astype(object)
+    mask = rng.random(len(values)) < rate
+    values[mask] = rng.choice(NULL_MARKERS, mask.sum())
+    return values
+
+BLOCK_SIZE = 4096
+
+def _block(name:str, block:int, seed:int) -> list:
+    """Returns the columns of a block of BLOCK_SIZE records"""
+    n = BLOCK_SIZE
+    offset = block * n
+    rng = np.random.default_rng([seed, block, len(name)])
+    ids = np.arange(offset, offset + n) + 1
+    
+    prov_idx = rng.integers(0, len(PROVINCIAS), n)
+    id_provincia = (prov_idx + 1) * 2
+    id_departamento = id_provincia * 1000 + rng.integers(1, 200, n)
+    cod_localidad = id_departamento * 1000 + rng.integers(1, 100, n)
+    provincia = np.array(PROVINCIAS, dtype=object)[prov_idx]
+    localidad = np.char.add('Localidad ', 
+                            (cod_localidad % 100000).astype(str))
+    nombre = np.char.add(f'{name} ', ids.astype(str))
+    direccion = _with_nulls(rng, np.char.add('Calle ', 
+                            rng.integers(1, 9999, n).astype(str)))
+    cp = _with_nulls(rng, rng.integers(1000, 9999, n).astype(str))
+    telefono = _with_nulls(rng, rng.integers(40000000, 49999999, n
+                                             ).astype(str))
+    mail = _with_nulls(rng, np.char.add(np.char.add('info', 
+                       ids.astype(str)), '@example.org'))
+    web = _with_nulls(rng, np.char.add('www.sitio', ids.astype(str)) 
+                      .astype(object), rate=0.5)
+    fuente = rng.choice(['Secretaria de Cultura de la Nación', 'CONABIP',
+                         'INCAA / SINCA', 'Gobierno Provincial'], n)
+    
+    if name == 'Museos':
+        columns = [ids, cod_localidad, id_provincia, 
+                   np.full(n, 'Espacios de Exhibición Patrimonial'), 
+                   provincia, localidad, nombre, direccion, cp, 
+                   telefono, mail, web, fuente]
+    else:
+        columns = [ids, cod_localidad.astype(str), 
+                   id_provincia.astype(str), id_departamento.astype(str),
+                   provincia, localidad, nombre, direccion, cp, 
+                   telefono, mail, web, fuente]
+        if name == 'Salas de cine':
+            columns += [rng.integers(1, 16, n).astype(str), 
+                        rng.integers(50, 3000, n).astype(str),
+                        rng.choice(['SI', 'si', '', '0'], n)]
+    return columns
+
+def records(name:str, offset:int, limit:int, total:int, 
+            seed:int=0) -> list:
+    """Returns the records of a synthetic dataset page.
+    Records are generated in fixed blocks, so every record is the
+    same whatever the page size used to request it.
+
+    Args:
+        name (str): Dataset name, a key of FIELDS
+        offset (int): First record number
+        limit (int): Page size
+        total (int): Dataset size
+        seed (int): Random seed. Defaults to 0
+
+    Returns:
+        A list of dicts, as CKAN datastore_search records
+    """
+    end = max(offset, min(offset + limit, total))
+    fields = FIELDS[name]
+    page = []
+    for block in range(offset // BLOCK_SIZE, 
+                       (end - 1) // BLOCK_SIZE + 1 if end > offset else 0):
+        start = max(offset - block * BLOCK_SIZE, 0)
+        stop = min(end - block * BLOCK_SIZE, BLOCK_SIZE)
+        columns = [col[start:stop].tolist() 
+                   for col in _block(name, block, seed)]
+        page += [dict(zip(fields, row)) for row in zip(*columns)]
+    return page
@@ -0,0 +1,301 @@
+"""This module keeps a download cache of datasets, keyed by
+CKAN resource id. For every resource it stores the http validators
+(ETag, Last-Modified), a content hash of the records, the path of the
+last csv snapshot and the already normalized pandas dataframe.
+It also keeps the keys and row hashes of the last incremental load
+of each database table, the load generation of each table and a
+cache of query results keyed by those generations"""
+
+from decouple import config
+from components.logs_config import log, log_settings
+import collections
+import hashlib
+import json
+import os
+import threading
+import pandas as pd
+
+CACHE_DIR = config('CACHE_DIR', default='cache')
+
+# Query results cache: entries and size kept in memory (LRU), and 
+# whether results are also saved to disk (shared by processes)
+QUERY_CACHE = config('QUERY_CACHE', default=True, cast=bool)
+QUERY_CACHE_ENTRIES = config('QUERY_CACHE_ENTRIES', default=128, cast=int)
+QUERY_CACHE_MAX_BYTES = config('QUERY_CACHE_MAX_BYTES', 
+                               default=67108864, cast=int)
+QUERY_CACHE_DISK = config('QUERY_CACHE_DISK', default=False, cast=bool)
+
+# In memory query results (key: (dataframe, bytes)), and
+# load generations read from disk (with the file inode and mtime)
+_RESULTS = collections.OrderedDict()
+_RESULTS_BYTES = 0
+_GENERATIONS = {'stamp': None, 'tables': {}}
+_LOCK = threading.Lock()
+
+# Configuring loggings
+log_settings()
+
+def _entry_path(resource_id:str) -> str:
+    return os.path.join(os.getcwd(), CACHE_DIR, f'{resource_id}.json')
+
+def _frame_path(resource_id:str) -> str:
+    return os.path.join(os.getcwd(), CACHE_DIR, f'{resource_id}.pkl')
+
+def hasher(columns:list):
+    """Returns a sha256 hash object started with the column names.
+    Dataframe chunks can then be added with update_hash().
+
+    Args:
+        columns (list): Column names
+
+    Returns:
+        A hashlib sha256 object
+    """
+    digest = hashlib.sha256()
+    digest.update('|'.join(map(str, columns)).encode())
+    return digest
+
+def update_hash(digest, df:pd.DataFrame) -> None:
+    """Adds the row hashes of a dataframe (or chunk) to digest.
+    Row hashes are computed vectorized by pandas."""
+    digest.update(pd.util.hash_pandas_object(df, index=False).values)
+
+def df_hash(df:pd.DataFrame) -> str:
+    """Returns a sha256 content hash of a pandas dataframe.
+    It is the same for the whole dataframe as for its chunks
+    added in order with update_hash().
+
+    Args:
+        df (pandas.DataFrame)
+
+    Returns:
+        A hex digest string
+    """
+    digest = hasher(df.columns)
+    update_hash(digest, df)
+    return digest.hexdigest()
+
+def load_entry(resource_id:str) -> dict:
+    """Returns the cache entry of a resource, 
+    or None if it was never cached.
+
+    Args:
+        resource_id (str): CKAN resource id
+
+    Returns:
+        A dict with 'etag', 'last_modified', 'hash',
+        'csv_path' and 'normalizer' keys, or None
+    """
+    path = _entry_path(resource_id)
+    if not (os.path.exists(path) and os.path.exists(_frame_path(resource_id))):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+def conditional_headers(entry:dict) -> dict:
+    """Builds If-None-Match / If-Modified-Since request headers
+    from a cache entry.
+
+    Args:
+        entry (dict): Retrieved from load_entry(). Can be None.
+
+    Returns:
+        A dict of http headers
+    """
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def load_frame(resource_id:str) -> pd.DataFrame:
+    """Returns the cached normalized dataframe of a resource
+
+    Args:
+        resource_id (str): CKAN resource id
+
+    Returns:
+        A pandas.DataFrame
+    """
+    return pd.read_pickle(_frame_path(resource_id))
+
+def save_entry(resource_id:str, entry:dict, df:pd.DataFrame=None) -> None:
+    """Saves a cache entry and, optionally, its normalized dataframe.
+
+    Args:
+        resource_id (str): CKAN resource id
+        entry (dict): 'etag', 'last_modified', 'hash', 'csv_path'
+        and 'normalizer'
+        df (pandas.DataFrame, optional): Normalized dataframe.
+        If None the previously cached dataframe is kept.
+    """
+    os.makedirs(os.path.join(os.getcwd(), CACHE_DIR), exist_ok=True)
+    if df is not None:
+        df.to_pickle(_frame_path(resource_id))
+    # Write then rename, so a reader never sees a partial entry
+    path = _entry_path(resource_id)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(entry, file)
+    os.replace(path + '.tmp', path)
+    log.info(f'{resource_id} cache entry saved')
+
+def _table_path(table:str) -> str:
+    return os.path.join(os.getcwd(), CACHE_DIR, f'table-{table}.pkl')
+
+def load_table_snapshot(table:str) -> pd.DataFrame:
+    """Returns the keys and row hashes saved by the last incremental
+    load of a database table, or None if there is none.
+
+    Args:
+        table (str): Database table name
+
+    Returns:
+        A pandas.DataFrame or None
+    """
+    path = _table_path(table)
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+def save_table_snapshot(table:str, df:pd.DataFrame) -> None:
+    """Saves the keys and row hashes loaded into a database table.
+
+    Args:
+        table (str): Database table name
+        df (pandas.DataFrame)
+    """
+    os.makedirs(os.path.join(os.getcwd(), CACHE_DIR), exist_ok=True)
+    df.to_pickle(_table_path(table))
+
+def forget_table_snapshot(table:str) -> None:
+    """Deletes the load snapshot of a database table, if any.
+
+    Args:
+        table (str): Database table name
+    """
+    path = _table_path(table)
+    if os.path.exists(path):
+        os.remove(path)
+
+def _generations_path() -> str:
+    return os.path.join(os.getcwd(), CACHE_DIR, 'generations.json')
+
+def generations() -> dict:
+    """Returns the load generation of every database table.
+    The file is read again only when another load changed it.
+
+    Returns:
+        A dict of table: generation
+    """
+    path = _generations_path()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    # The file is replaced on every change, so its inode changes
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+    if stamp != _GENERATIONS['stamp']:
+        with open(path) as file:
+            tables = json.load(file)
+        _GENERATIONS.update(stamp=stamp, tables=tables)
+    return _GENERATIONS['tables']
+
+def bump_generation(table:str) -> int:
+    """Increases the load generation of a database table, so
+    cached query results that read it are no longer used.
+
+    Args:
+        table (str): Database table name
+
+    Returns:
+        The new generation
+    """
+    with _LOCK:
+        tables = dict(generations())
+        tables[table] = tables.get(table, 0) + 1
+        os.makedirs(os.path.join(os.getcwd(), CACHE_DIR), exist_ok=True)
+        path = _generations_path()
+        with open(path + '.tmp', 'w') as file:
+            json.dump(tables, file)
+        os.replace(path + '.tmp', path)
+        return tables[table]
+
+def result_key(query:str, bind_params:dict, tables:list) -> str:
+    """Returns the cache key of a query result: a hash of the query,
+    its bound parameters and the load generations of the tables it
+    reads (of every table if they are not known).
+
+    Args:
+        query (str): Sql text
+        bind_params (dict)
+        tables (list): Tables read by the query
+
+    Returns:
+        A hex digest string
+    """
+    loaded = generations()
+    if tables:
+        loaded = {table: loaded.get(table, 0) for table in sorted(tables)}
+    payload = json.dumps([query, bind_params, loaded], 
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _result_path(key:str) -> str:
+    return os.path.join(os.getcwd(), CACHE_DIR, 'queries', f'{key}.pkl')
+
+def _remember(key:str, df:pd.DataFrame) -> None:
+    """Adds a result to the memory LRU, evicting the least 
+    recently used ones over the size limits"""
+    global _RESULTS_BYTES
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > QUERY_CACHE_MAX_BYTES:
+        return
+    with _LOCK:
+        if key in _RESULTS:
+            _RESULTS_BYTES -= _RESULTS.pop(key)[1]
+        _RESULTS[key] = (df, size)
+        _RESULTS_BYTES += size
+        while (len(_RESULTS) > QUERY_CACHE_ENTRIES 
+               or _RESULTS_BYTES > QUERY_CACHE_MAX_BYTES):
+            _RESULTS_BYTES -= _RESULTS.popitem(last=False)[1][1]
+
+def load_result(key:str) -> pd.DataFrame:
+    """Returns a cached query result (a copy of it), 
+    or None if there is none.
+
+    Args:
+        key (str): Retrieved from result_key()
+
+    Returns:
+        A pandas.DataFrame or None
+    """
+    with _LOCK:
+        hit = _RESULTS.get(key)
+        if hit is not None:
+            _RESULTS.move_to_end(key)
+    if hit is not None:
+        return hit[0].copy()
+    
+    if QUERY_CACHE_DISK and os.path.exists(_result_path(key)):
+        df = pd.read_pickle(_result_path(key))
+        _remember(key, df)
+        return df.copy()
+    return None
+
+def save_result(key:str, df:pd.DataFrame) -> None:
+    """Caches a query result in memory and, if QUERY_CACHE_DISK
+    is set, on disk.
+
+    Args:
+        key (str): Retrieved from result_key()
+        df (pandas.DataFrame)
+    """
+    df = df.copy()
+    _remember(key, df)
+    if QUERY_CACHE_DISK:
+        path = _result_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
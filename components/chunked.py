@@ -0,0 +1,80 @@
+"""This module runs the whole pipeline in chunks: every page of 
+records is downloaded, appended to its csv snapshot, normalized and 
+copied into the sitios table before the next one is fetched, while 
+totales and cines are computed incrementally from the chunks. 
+Peak memory depends on the chunk size, not on the dataset sizes.
+
+sitios is copied as it arrives, so it is not deduplicated, and 
+totales and cines are plain tables: AGGREGATION = database and
+upsert loads of sitios are not supported in chunks"""
+
+from components.logs_config import log, log_settings
+import components.downloader as dw
+import components.dataframe_processor as proc
+import components.dbconnector as con
+import components.dedup as dedup
+import components.metrics as metrics
+import sys
+
+# Configuring loggings
+log_settings()
+
+def check_settings() -> None:
+    """Raises ValueError on settings the chunked pipeline can not
+    honor, and warns that sitios are not deduplicated"""
+    unsupported = []
+    if con.AGGREGATION != 'pandas':
+        unsupported.append(f'AGGREGATION = {con.AGGREGATION}')
+    if con.SITIOS_LOAD_METHOD != 'copy':
+        unsupported.append(f'SITIOS_LOAD_METHOD = '
+                           f'{con.SITIOS_LOAD_METHOD}')
+    if unsupported:
+        raise ValueError(f'{", ".join(unsupported)} not supported '
+                         'with CHUNK_SIZE, set CHUNK_SIZE = 0')
+    if dedup.DEDUPLICATE:
+        log.warning('sitios are not deduplicated in chunks '
+                    '(CHUNK_SIZE), set CHUNK_SIZE = 0 to do it')
+
+@metrics.instrument
+def run(chunk_size:int=None) -> dict:
+    """Downloads every dataset in chunks and creates the
+    sitios, totales and cines tables.
+
+    Args:
+        chunk_size (int, optional): Records per chunk. 
+        Defaults to CHUNK_SIZE setting (or PAGE_SIZE if unset).
+
+    Returns:
+        A dict with the totales and cines dataframes (small)
+    """
+    try:
+        check_settings()
+    except:
+        type, value, traceback = sys.exc_info()
+        log.error(f'{type}, {value}')
+        sys.exit(1)
+    
+    chunk_size = chunk_size or dw.CHUNK_SIZE or dw.PAGE_SIZE
+    state = {'totales': None, 'cines': None}
+    
+    def sitios_chunks():
+        for dataset in dw.DATASETS:
+            for raw in dw.api_to_csv_chunks(dataset, page_size=chunk_size):
+                if dataset['name'] == 'Salas de cine':
+                    state['cines'] = proc.cines_counts(raw, state['cines'])
+                norm = proc.normalize(raw, dataset)
+                del raw
+                state['totales'] = proc.totales_counts(norm, 
+                                                       state['totales'])
+                yield norm
+    
+    con.create_database()
+    con.df_chunks_to_dbtable(sitios_chunks(), table='sitios')
+    
+    totales = proc.totales_from_counts(state['totales'])
+    con.df_to_dbtable(totales, table='totales')
+    cines = proc.cines_from_counts(state['cines'])
+    con.df_to_dbtable(cines, table='cines')
+    
+    log.info(f'Chunked pipeline finished (chunks of {chunk_size} records)')
+    return {'totales': totales, 'cines': cines}
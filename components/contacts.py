@@ -0,0 +1,139 @@
+"""This module cleans the contact columns of normalized datasets:
+phones, emails, web sites, postal codes and addresses.
+Every column is cleaned at once with vectorized pandas string
+methods and the precompiled regular expressions below, so no
+python code runs per row."""
+
+import re
+import pandas as pd
+
+# Phone lists ("4123-4567 / 4123-4568", "... int. 12"): the
+# first phone is kept
+PHONE_SEPARATORS = re.compile(r'\s*(?:/|;|,|\by\b|\bo\b|\bint\b\.?)\s*',
+                              re.IGNORECASE)
+# Country prefix (+54, 0054) and mobile 9
+PHONE_COUNTRY = re.compile(r'^\s*(?:\+|00)\s*54[\s-]*(?:9[\s-]*)?')
+# Area code apart from the number: "(0351) 423-4567", "011 4123-4567".
+# A leading 15 is the mobile prefix ("15-5555-5555"), kept in the
+# number, not an area code
+PHONE_AREA = re.compile(
+    r'^\(?\s*0?(?!15\b)(?P<area>[1-9]\d{1,3})\s*\)?[\s.-]+'
+    r'(?P<number>\d[\d\s.-]{5,})$')
+# Float values of numeric columns ("41234567.0")
+FLOAT_SUFFIX = re.compile(r'\.0$')
+NON_DIGITS = re.compile(r'\D')
+
+# Emails: the first of a list, without mailto:
+EMAIL_SEPARATORS = re.compile(r'[\s;,/]+')
+EMAIL_PREFIX = re.compile(r'^mailto:', re.IGNORECASE)
+EMAIL = re.compile(r'^[a-z0-9._%+-]+@[a-z0-9-]+(?:\.[a-z0-9-]+)*\.[a-z]{2,}$')
+
+# Urls: scheme (http:// if missing), lower case host, path kept
+URL = re.compile(r'^(?:(?P<scheme>[a-z][a-z0-9+.-]*)://)?'
+                 r'(?P<host>[^/?#\s]+)(?P<path>[^\s]*)$',
+                 re.IGNORECASE)
+HOST = re.compile(r'^(?:[a-z0-9-]+\.)+[a-z0-9-]+\.?(?::\d+)?$')
+
+# Postal codes: 4 digits, or CPA (province letter, 4 digits and
+# 3 letters for the block side), e.g. 5000 or X5000ABC
+POSTAL_CODE_NOISE = re.compile(r'[\s.-]|^CP:?|^C\.P\.?', re.IGNORECASE)
+POSTAL_CODE = re.compile(r'^[A-Z]?\d{4}(?:[A-Z]{3})?$')
+
+WHITESPACE = re.compile(r'\s+')
+
+def _digits(col:pd.Series) -> pd.Series:
+    return col.str.replace(NON_DIGITS, '', regex=True)
+
+def _to_int(col:pd.Series, dtype:str, min_len:int, max_len:int) -> pd.Series:
+    """Parses digit strings of valid length as nullable integers"""
+    valid = col.str.len().between(min_len, max_len)
+    return pd.to_numeric(col.where(valid), errors='coerce').astype(dtype)
+
+def phones(phone:pd.Series, area:pd.Series=None) -> pd.DataFrame:
+    """Parses phones into area code and number.
+
+    Args:
+        phone (pandas.Series): Raw phones
+        area (pandas.Series, optional): Raw area codes, if the
+        dataset has them apart. Otherwise (or if null) they are
+        taken from the phones, when written apart from the number.
+
+    Returns:
+        A pandas.DataFrame with 'cod_area' (Int16) and
+        'numero_de_telefono' (Int64) columns, null if not valid
+    """
+    text = phone.astype('string').str.replace(FLOAT_SUFFIX, '', regex=True)
+    text = text.str.split(PHONE_SEPARATORS, n=1, regex=True).str[0]
+    text = text.str.replace(PHONE_COUNTRY, '', regex=True).str.strip()
+
+    parts = text.str.extract(PHONE_AREA)
+    number = _digits(parts['number'].fillna(text))
+    parsed_area = parts['area']
+
+    if area is not None:
+        given = area.astype('string').str.replace(FLOAT_SUFFIX, '',
+                                                  regex=True)
+        given = _digits(given).str.lstrip('0').replace('', pd.NA)
+        parsed_area = given.fillna(parsed_area)
+
+    # Trunk 0 of national numbers written without area apart
+    number = number.str.lstrip('0')
+    return pd.DataFrame({'cod_area': _to_int(parsed_area, 'Int16', 2, 4),
+                         'numero_de_telefono': _to_int(number, 'Int64',
+                                                       6, 10)},
+                        index=phone.index)
+
+def emails(mail:pd.Series) -> pd.Series:
+    """Lower case emails, the first one of lists,
+    null if not valid"""
+    text = mail.astype('string').str.strip().str.lower()
+    text = text.str.replace(EMAIL_PREFIX, '', regex=True)
+    text = text.str.split(EMAIL_SEPARATORS, n=1, regex=True).str[0]
+    return text.where(text.str.match(EMAIL))
+
+def urls(web:pd.Series) -> pd.Series:
+    """Urls with lower case scheme and host (http:// if missing)
+    and without a trailing slash, null if not valid"""
+    parts = web.astype('string').str.strip().str.extract(URL)
+    scheme = parts['scheme'].str.lower().fillna('http')
+    host = parts['host'].str.lower().str.rstrip('.')
+    path = parts['path'].str.rstrip('/')
+    url = scheme + '://' + host + path
+    return url.where(host.str.match(HOST))
+
+def postal_codes(code:pd.Series) -> pd.Series:
+    """Upper case postal codes without separators,
+    null if not valid"""
+    text = code.astype('string').str.replace(FLOAT_SUFFIX, '', regex=True)
+    text = text.str.replace(POSTAL_CODE_NOISE, '', regex=True).str.upper()
+    return text.where(text.str.match(POSTAL_CODE))
+
+def addresses(address:pd.Series) -> pd.Series:
+    """Addresses with single spaces and no surrounding ones"""
+    text = address.astype('string').str.strip()
+    return text.str.replace(WHITESPACE, ' ', regex=True)
+
+def clean_contacts(df:pd.DataFrame) -> pd.DataFrame:
+    """Cleans the contact columns of a normalized dataframe
+    (the ones it has), column by column.
+
+    Args:
+        df (pandas.DataFrame): With DB_COLUMN_NAMES columns of
+        dataframe_processor module.
+
+    Returns:
+        A pandas.DataFrame
+    """
+    if 'numero_de_telefono' in df.columns:
+        parsed = phones(df['numero_de_telefono'], df.get('cod_area'))
+        df['cod_area'] = parsed['cod_area']
+        df['numero_de_telefono'] = parsed['numero_de_telefono']
+    if 'mail' in df.columns:
+        df['mail'] = emails(df['mail'])
+    if 'web' in df.columns:
+        df['web'] = urls(df['web'])
+    if 'codigo_postal' in df.columns:
+        df['codigo_postal'] = postal_codes(df['codigo_postal'])
+    if 'domicilio' in df.columns:
+        df['domicilio'] = addresses(df['domicilio'])
+    return df
@@ -1,98 +1,185 @@
 """This module has functions needed for normalizing the downloaded
 datasets and for concatenating them into one pandas dataframe"""
 
+from decouple import config
 from components.logs_config import log, log_settings
+import components.snapshots as snapshots
+import components.contacts as contacts
+import components.metrics as metrics
 import sys
 import os
+import hashlib
+import json
 import pandas as pd
-import numpy as np
 
 # Target Column names
 DB_COLUMN_NAMES = ['cod_localidad', 'id_provincia', 'id_departamento', 
                    'categoria', 'provincia', 'localidad', 
-                   'nombre', 'domicilio', 'codigo_postal', 
+                   'nombre', 'domicilio', 'codigo_postal', 'cod_area',
                    'numero_de_telefono', 'mail', 'web', 'fuente'
                    ]
 
+# String columns dtype: 'object', 'string' or 'string[pyarrow]'
+# (arrow backed strings require pyarrow)
+STRING_DTYPE = config('STRING_DTYPE', default='string')
+
+# Compact dtypes of DB_COLUMN_NAMES columns. Ids are nullable
+# integers, low cardinality columns are categorical
+DB_SCHEMA = {'cod_localidad': 'Int32', 
+             'id_provincia': 'Int8', 
+             'id_departamento': 'Int32', 
+             'categoria': 'category', 
+             'provincia': 'category', 
+             'localidad': 'string', 
+             'nombre': 'string', 
+             'domicilio': 'string', 
+             'codigo_postal': 'string', 
+             'cod_area': 'Int16', 
+             'numero_de_telefono': 'Int64', 
+             'mail': 'string', 
+             'web': 'string', 
+             'fuente': 'category'
+             }
+
+# Columns of the cinemas dataset used by cines()
+CINES_COLUMNS = ['provincia', 'pantallas', 'butacas', 'espacio_incaa']
+
+# Column transforms that datasets can declare in their registry
+# entry (see load_registry() of downloader module), as 
+# {"op": name, "source": column, "target": column, "value": ...}
+TRANSFORMS = {
+    # Integer division, e.g. department code from locality code
+    'floordiv': lambda col, value: (
+        pd.to_numeric(col) // value).astype('int64')
+    }
+
+# Values treated as null in string columns
+NULL_MARKERS = ['s/d', '',' ', '"']
+
+# Version of normalize() output. Increase it whenever normalize()
+# (or contacts cleaning) changes, so cached frames are rebuilt
+NORMALIZER_VERSION = 3
+
+def normalizer_key(dataset:dict) -> str:
+    """Returns a hash of everything normalize() output of a
+    dataset depends on, besides the raw data: the registry entry,
+    NORMALIZER_VERSION and the target columns and dtypes"""
+    payload = json.dumps([dataset, NORMALIZER_VERSION, DB_COLUMN_NAMES,
+                          DB_SCHEMA, STRING_DTYPE], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
 # Configuring loggings
 log_settings()
 
+def _mask_null_markers(df:pd.DataFrame, 
+                       markers:list=NULL_MARKERS
+                       ) -> pd.DataFrame:
+    """Replaces null markers with NaN, column by column and only
+    in object (string) columns. Numeric columns are left untouched.
+    Columns are re-inferred afterwards, as DataFrame.replace does."""
+    replaced = False
+    for col in df.columns:
+        if not pd.api.types.is_string_dtype(df[col].dtype):
+            continue
+        mask = df[col].isin(markers)
+        if mask.any():
+            df[col] = df[col].mask(mask)
+            replaced = True
+    return df.infer_objects() if replaced else df
+
+@metrics.instrument
+def apply_schema(df:pd.DataFrame, schema:dict=DB_SCHEMA) -> pd.DataFrame:
+    """Casts the columns of a dataframe to the dtypes of schema.
+    Integer columns are parsed from strings if needed and 'string'
+    columns use STRING_DTYPE setting. Columns not in the schema are
+    kept as they are.
+
+    Args:
+        df (pandas.DataFrame)
+        schema (dict): column: dtype. Defaults to DB_SCHEMA
+
+    Returns:
+        A pandas.DataFrame
+    """
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'string':
+            dtype = STRING_DTYPE
+        if dtype.startswith('Int'):
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def _union_categories(df_list:list) -> list:
+    """Sets the same categories to the categorical columns of
+    every dataframe, so concatenating keeps them categorical"""
+    cols = [col for col, dtype in DB_SCHEMA.items() if dtype == 'category']
+    for col in cols:
+        if not all(col in df.columns and 
+                   isinstance(df[col].dtype, pd.CategoricalDtype) 
+                   for df in df_list):
+            continue
+        categories = pd.api.types.union_categoricals(
+            [df[col].array for df in df_list]).categories
+        df_list = [df.assign(**{col: df[col].cat.set_categories(categories)})
+                   for df in df_list]
+    return df_list
+
+@metrics.instrument
 def normalize(df:pd.DataFrame, 
               dataset:dict, 
               drop_old_cols:bool=True
               ) -> pd.DataFrame:
     """Normalizes dataset columns for future concatenation.
     dataset argument is needed to retrieve dataset category name.
+    The input dataframe is not modified. Columns are cast to the
+    compact dtypes of DB_SCHEMA.
     
     Args:
         df (pandas.DataFrame). Has to be a dataframe created
         with api_to_df() function of downloader module.
         dataset (dict): Has to be a dictionary retrieved from
         DATASET variable of downloader module. Needed to retrieve
-        dataset category name.
+        dataset category name, column renames and transforms.
         drop_old_cols (bool): If False it keeps original columns.
         Defaults to True
     
     Returns: 
         A pandas.DataFrame"""
     try:
-        # Transform column names to lowercase
-        df.columns = map(str.lower, df.columns) 
+        # Transform column names to lowercase (on a shallow copy)
+        df = df.rename(columns=str.lower)
         
         # Insert 'categoría' column
         df['categoria'] = dataset['name']
         
-        if dataset['name'] == 'Museos':
-            # localidad_id refactorization
-            df['id_departamento'] = df['localidad_id'].apply(
-                lambda x: str(x)[:-3]).astype('int64')
-            
-            # Rename columns
-            df.rename(columns = {'localidad_id':'cod_localidad', 
-                                'provincia_id':'id_provincia', 
-                                'id_departamento':'id_departamento', 
-                                'direccion':'domicilio', 
-                                'codigo_postal':'codigo_postal', 
-                                'telefono':'numero_de_telefono'
-                                },
-                    inplace = True)
+        # Declared transforms, e.g. museums id_departamento is
+        # localidad_id without its last three digits
+        for transform in dataset.get('transforms', []):
+            func = TRANSFORMS[transform['op']]
+            df[transform['target']] = func(df[transform['source']], 
+                                           transform.get('value'))
         
-        elif dataset['name'] == 'Salas de cine':
-                        
-            # Rename columns
-            df.rename(columns = {'cod_loc':'cod_localidad', 
-                                'idprovincia':'id_provincia', 
-                                'iddepartamento':'id_departamento', 
-                                'direccion':'domicilio', 
-                                'cp':'codigo_postal', 
-                                'teléfono':'numero_de_telefono',
-                                'Fuente':'fuente'
-                                },
-                    inplace = True)
-            
-        elif dataset['name'] == 'Bibliotecas populares':
-            
-            # Rename columns
-            df.rename(columns = {'cod_loc':'cod_localidad', 
-                                'idprovincia':'id_provincia', 
-                                'iddepartamento':'id_departamento', 
-                                'direccion':'domicilio', 
-                                'cp':'codigo_postal', 
-                                'teléfono':'numero_de_telefono',
-                                'Fuente':'fuente'
-                                },
-                    inplace = True)
+        # Rename columns
+        df = df.rename(columns=dataset.get('renames', {}))
             
         # Subset and reorder columns
         if drop_old_cols==True:
             df = df.reindex(columns=DB_COLUMN_NAMES)
+        else:
+            df = df.copy()
             
         # null values refactorization
-        to_replace = ['s/d', '',' ', '"']
-        final_df = df.replace(to_replace=to_replace, value=np.nan)
+        final_df = _mask_null_markers(df)
+        
+        # Phones (area code and number), emails, urls, 
+        # postal codes and addresses cleaning
+        final_df = contacts.clean_contacts(final_df)
         
-        # numero_de_telefono refactorization
-        final_df.numero_de_telefono = final_df.numero_de_telefono.astype('float64')
+        # Compact dtypes
+        final_df = apply_schema(final_df)
         
         name = dataset['name'].replace(' ', '_').lower()
         log.info(f'{name} dataset normalized')
@@ -105,10 +192,13 @@ def normalize(df:pd.DataFrame,
         sys.exit(1)
 
 
+@metrics.instrument
 def df_concat(df_list:list # of pandas dataframes
               ) -> pd.DataFrame:
     """Concatenates a list of 
-    pandas dataframes into one dataframe
+    pandas dataframes into one dataframe.
+    Categorical columns keep a dtype with the union 
+    of the categories of every dataframe.
     
     Args:
         df_list (a list of pandas.DataFrames)
@@ -117,6 +207,7 @@ def df_concat(df_list:list # of pandas dataframes
         A pandas.DataFrame
     """
     try:
+        df_list = _union_categories(list(df_list))
         df = pd.concat(df_list, axis=0, ignore_index = True)
         
         log.info('All datasets combined into one pandas dataframe')
@@ -127,61 +218,104 @@ def df_concat(df_list:list # of pandas dataframes
         log.error(f'{type}, {value}')
         sys.exit(1)
         
-def totales(df:pd.DataFrame) -> pd.DataFrame:
+def _tally(counts:pd.Series, column:str) -> pd.DataFrame:
+    """Turns a counts series into 'columna', 'valor' 
+    and 'registros_totales' rows"""
+    return pd.DataFrame({'columna': column,
+                         'valor': counts.index.astype(object),
+                         'registros_totales': counts.values})
+
+def totales_counts(df:pd.DataFrame, counts:pd.Series=None) -> pd.Series:
+    """Counts rows by 'provincia', 'categoria' and 'fuente' in a
+    single pass, adding them to previous counts if given. Counts
+    of consecutive chunks can so be accumulated for totales().
+
+    Args:
+        df (pandas.DataFrame): A dataframe or chunk, as in totales()
+        counts (pandas.Series, optional): Previous counts
+
+    Returns:
+        A pandas.Series of counts, one row per distinct group
+    """
+    groups = df.groupby(['provincia', 'categoria', 'fuente'], 
+                        dropna=False, observed=True, 
+                        sort=False).size()
+    if counts is None:
+        return groups
+    # Groups keep their order of first appearance
+    return pd.concat([counts, groups]).groupby(
+        level=[0, 1, 2], dropna=False, sort=False).sum()
+
+def totales_from_counts(counts:pd.Series) -> pd.DataFrame:
+    """Creates the totales dataframe from totales_counts() counts
+
+    Args:
+        counts (pandas.Series)
+
+    Returns:
+        A pandas.DataFrame
+    """
+    # Categoría and fuente value counts (nulls excluded),
+    # ties kept in order of appearance as value_counts does
+    categoria = counts.groupby(level='categoria', sort=False).sum(
+        ).sort_values(ascending=False, kind='stable')
+    fuente = counts.groupby(level='fuente', sort=False).sum(
+        ).sort_values(ascending=False, kind='stable')
+    
+    # Provincia and categoría value counts, sorted by both
+    # names (categorical levels would sort by category order)
+    prov_cat = counts.groupby(level=['provincia', 'categoria'], 
+                              dropna=False, sort=False).sum()
+    provincia = prov_cat.index.get_level_values(0).astype(object)
+    categoria_ = prov_cat.index.get_level_values(1).astype(object)
+    prov_cat.index = pd.MultiIndex.from_arrays([provincia, categoria_])
+    prov_cat = prov_cat.sort_index(na_position='last')
+    
+    # 'provincia - categoria' labels, only for distinct groups
+    # Null names written as 'nan' (whatever the pandas version),
+    # as the totales materialized view does
+    labels = (prov_cat.index.get_level_values(0).fillna('nan').astype(str)
+              + ' - ' 
+              + prov_cat.index.get_level_values(1).fillna('nan').astype(str))
+    prov_cat.index = labels
+    
+    # Final dataframe concatenation
+    return pd.concat([_tally(categoria, 'categoria'),
+                      _tally(fuente, 'fuente'),
+                      _tally(prov_cat, 'provincia_categoria')], 
+                     axis=0, ignore_index = True)
+
+@metrics.instrument
+def totales(df) -> pd.DataFrame:
     """Creates a new dataframe with unique value 
     counts of the following columns:
         -'categoria'\n
         -'fuente'\n
         -'provincia' and 'categoria' concatenated
     
+    Rows are counted once, grouping by the three columns, and the
+    three tallies are derived from those (few) groups. 
+    The input dataframe is not modified.
+    
     Args:
-        df (pandas.DataFrame): Has to be a 
-        pandas dataframe generated from 
+        df (pandas.DataFrame or iterable of pandas.DataFrame): 
+        Has to be a pandas dataframe generated from 
         download_datasets() 
-        function of downloader module.
+        function of downloader module. An iterator of chunks 
+        of it is counted incrementally.
     
     Returns:
         A pandas.DataFrame
     """
     try:
-        # Categoría value counts
-        categoria = df.categoria.value_counts()
-
-        # Fuente value counts
-        fuente = df.fuente.value_counts()
-        
-        # Provincia and categoría value counts
-        cols = ['provincia', 'categoria']  # column selection
-        df.sort_values(by=cols, inplace=True) # sorting
-        df['prov_cat'] = df[cols].apply( #new combined column
-            lambda row: ' - '.join(
-                row.values.astype(str)
-                ), axis=1
-            )
-        prov_cat = df.prov_cat.value_counts(sort=False)
+        if isinstance(df, pd.DataFrame):
+            counts = totales_counts(df)
+        else:
+            counts = None
+            for chunk in df:
+                counts = totales_counts(chunk, counts)
         
-        # A dictionary with value counts dataframes to iterate
-        data = {'categoria': categoria,
-                'fuente': fuente,
-                'provincia_categoria': prov_cat}
-        
-        # An empty list to retrieve the dataframes
-        df_list = []
-        
-        # New columns for final dataframe
-        new_cols = ['columna', 'valor', 'registros_totales']
-        
-        # dataframe iteration processing
-        for key, val in data.items():
-            temp_df = pd.DataFrame(val)
-            temp_df.reset_index(inplace=True)
-            temp_df.columns = [new_cols[1], new_cols[2]]
-            temp_df[new_cols[0]] = key
-            temp_df = temp_df.reindex(columns=new_cols)
-            df_list.append(temp_df)
-        
-        # Final dataframe concatenation
-        final_df = pd.concat(df_list, axis=0, ignore_index = True)
+        final_df = totales_from_counts(counts)
         
         log.info('totales dataframe created')
         
@@ -192,39 +326,71 @@ def totales(df:pd.DataFrame) -> pd.DataFrame:
         log.error(f'{typ}, {value}')
         sys.exit(1)
         
-def csv_to_df(category:str='salas_de_cine') -> pd.DataFrame:
+def _scan_latest_csv(path:str) -> str:
+    """Returns the most recently created csv file under path.
+    Used for categories saved before manifests existed."""
+    # An empty list to retrieve csv file paths
+    list_of_files = []
+    
+    # Loop for retrieve the list of csv file paths
+    for (root, dirs, files) in os.walk(path, topdown=True):
+        for name in files:
+            filepath = (os.path.join(root, name))
+            if filepath[-4:] == '.csv':
+                list_of_files.append(filepath)
+    
+    # Retrieve the last csv file path
+    return max(list_of_files, key=os.path.getctime)
+
+@metrics.instrument
+def csv_to_df(category:str='salas_de_cine', 
+              columns:list=None
+              ) -> pd.DataFrame:
     """Looks for the last saved csv of selected category
-    and converts it to a pandas dataframe
+    and converts it to a pandas dataframe.
+    
+    The last csv is taken from the category manifest. If the
+    dataframe saved in it is still in memory (handed over by 
+    the downloader module in this process) it is returned 
+    without reading the file. If the snapshot has a columnar 
+    copy, only the selected columns are read from it.
 
     Args:
         category (str, optional): Category of data look for csv file.
         {'bibliotecas_populares', 'museos', 'salas_de_cine'}
         Defaults to 'salas_de_cine'.
+        columns (list, optional): Columns to load (case insensitive).
+        Defaults to all columns.
 
     Returns:
         A pandas.DataFrame
     """
     try:
-        # The path for searching the csv file
-        path = os.path.join(os.getcwd(),
-                            'csv',
-                            category)
-        
-        # An empty list to retrieve csv file paths
-        list_of_files = []
-        
-        # Loop for retrieve the list of csv file paths
-        for (root, dirs, files) in os.walk(path, topdown=True):
-            for name in files:
-                filepath = (os.path.join(root, name))
-                if filepath[-4:] == '.csv':
-                    list_of_files.append(filepath)
-        
-        # Retrieve the last csv file path
-        latest_file = max(list_of_files, key=os.path.getctime)
+        entry = snapshots.latest(category)
+        if entry:
+            latest_file = entry['path']
+            df = snapshots.take(latest_file)
+            if df is not None:
+                log.info(f'Last {category} dataframe taken from memory')
+                return snapshots.select_columns(df, columns)
+            if entry.get('columnar'):
+                df = snapshots.read_columnar(entry['columnar'], columns)
+                log.info(f'Last {category} snapshot saved to pandas dataframe')
+                return df
+        else:
+            # The path for searching the csv file
+            path = os.path.join(os.getcwd(),
+                                'csv',
+                                category)
+            latest_file = _scan_latest_csv(path)
         
         # Convert csv file to a pandas dataframe
-        df = pd.read_csv(latest_file)
+        if columns is None:
+            df = pd.read_csv(latest_file)
+        else:
+            wanted = {col.lower() for col in columns}
+            df = pd.read_csv(latest_file, 
+                             usecols=lambda col: col.lower() in wanted)
         
         log.info(f'Last {category} csv file saved to pandas dataframe')
         
@@ -235,52 +401,90 @@ def csv_to_df(category:str='salas_de_cine') -> pd.DataFrame:
         log.error(f'{typ}, {value}')
         sys.exit(1)
         
-def cines(df:pd.DataFrame) -> pd.DataFrame:
+def cines_counts(df:pd.DataFrame, counts:pd.DataFrame=None) -> pd.DataFrame:
+    """Aggregates cinemas data by 'provincia', adding it to previous
+    counts if given. Counts of consecutive chunks can so be 
+    accumulated for cines().
+
+    Args:
+        df (pandas.DataFrame): A dataframe or chunk, as in cines()
+        counts (pandas.DataFrame, optional): Previous counts
+
+    Returns:
+        A pandas.DataFrame indexed by provincia
+    """
+    cols = CINES_COLUMNS
+    
+    # Transform column names to lowercase
+    temp_df = df.rename(columns=str.lower)[cols]
+    
+    # Numeric columns, null markers become NaN
+    pantallas = pd.to_numeric(temp_df[cols[1]], errors='coerce')
+    butacas = pd.to_numeric(temp_df[cols[2]], errors='coerce')
+    
+    # Lower espacio_incaa values, null markers become NaN
+    incaa = temp_df[cols[3]].astype('string').str.strip().str.lower()
+    incaa = incaa.mask(incaa.isin(['s/d', '', '"', '0']))
+    
+    temp_df = pd.DataFrame({cols[0]: temp_df[cols[0]],
+                            cols[1]: pantallas,
+                            cols[2]: butacas,
+                            cols[3]: incaa})
+    
+    # Sum pantallas and butacas and count espacios_incaa
+    # grouped by provincia, in a single pass
+    partial = temp_df.groupby(cols[0], observed=True).agg(
+        pantallas=(cols[1], 'sum'),
+        butacas=(cols[2], 'sum'),
+        espacio_incaa=(cols[3], 'count'))
+    
+    # Partial results are small (one row per provincia)
+    if counts is None:
+        return partial
+    return counts.add(partial, fill_value=0)
+
+def cines_from_counts(counts:pd.DataFrame) -> pd.DataFrame:
+    """Creates the cines dataframe from cines_counts() counts
+
+    Args:
+        counts (pandas.DataFrame)
+
+    Returns:
+        A pandas.DataFrame
+    """
+    final_df = counts.astype('int64')
+    
+    # Reset dataframe index
+    return final_df.reset_index()
+
+@metrics.instrument
+def cines(df) -> pd.DataFrame:
     """Creates a new dataframe with the sum of the
     following columns, grouped by 'provincia' column:
         -'pantallas'\n
         -'butacas'\n
-        -'espacio_incaa'
+        -'espacio_incaa' (count of non null values)
 
     Args:
-        df (pandas.DataFrame): Has to be a pandas dataframe
-        generated from csv_to_df() function of this module, 
-        with category argument set to 'salas_de_cine' (default).
+        df (pandas.DataFrame or iterable of pandas.DataFrame): 
+        Has to be a pandas dataframe generated from csv_to_df() 
+        function of this module, with category argument set to 
+        'salas_de_cine' (default). An iterator of chunks of it
+        (e.g. pandas.read_csv with chunksize) is aggregated 
+        incrementally.
 
     Returns:
         A pandas.DataFrame
     """
     try:
-        # List of columns to retrieve for further processing 
-        cols = ['provincia', 'pantallas', 'butacas', 'espacio_incaa']
-        
-        # Transform column names to lowercase
-        df.columns = map(str.lower, df.columns)
-        temp_df = df[cols]
-        
-        # null values refactorization
-        to_replace = ['s/d', '',' ', '"', '0']
-        temp_df = temp_df.replace(to_replace=to_replace, value=np.nan)
-        
-        # Lower espacio_incaa values
-        temp_df[cols[3]] = temp_df[cols[3]].apply(
-            lambda x: x.lower() if x is str else x
-            )
-        
-        # Sum pantallas and butacas grouped by provincia
-        final_df = temp_df.groupby(
-            [cols[0]]
-            )[cols[1:3]].apply(
-                lambda x : x.astype(int).sum())
-        
-        # Count espacios_incaa grouped by provincia
-        final_df[cols[3]] = temp_df.groupby(
-            [cols[0]]
-            )[cols[3]].apply(
-                lambda x : x.count())
-        
-        # Reset dataframe index
-        final_df.reset_index(inplace=True)
+        if isinstance(df, pd.DataFrame):
+            counts = cines_counts(df)
+        else:
+            counts = None
+            for chunk in df:
+                counts = cines_counts(chunk, counts)
+        
+        final_df = cines_from_counts(counts)
         
         log.info('cines dataframe created')
         
@@ -4,11 +4,19 @@ and create all the required tables.
 """
 
 import sys
+import io
+import os
 import pandas as pd
 from decouple import config
 from components.logs_config import log, log_settings
+import components.cache as cache
+import components.metrics as metrics
 import urllib.parse
-from sqlalchemy import create_engine, text
+import re
+import threading
+import functools
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
 
 DIALECT = config('DIALECT')
 DRIVER = config('DRIVER')
@@ -19,119 +27,647 @@ PORT = config('PORT')
 DB_NAME = config('DB_NAME')
 ENGINE_URL = f'{DIALECT}+{DRIVER}://{USER}:{PASS}@{DB_HOST}:{PORT}'
 DB_URL = ENGINE_URL + '/' + DB_NAME
+LOAD_METHOD = config('LOAD_METHOD', default='copy')
+POOL_SIZE = config('POOL_SIZE', default=5, cast=int)
+MAX_OVERFLOW = config('MAX_OVERFLOW', default=10, cast=int)
+POOL_PRE_PING = config('POOL_PRE_PING', default=True, cast=bool)
+POOL_RECYCLE = config('POOL_RECYCLE', default=1800, cast=int)
+# sql templates of the project, wherever it is run from
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                       os.pardir, 'sql')
+SITIOS_LOAD_METHOD = config('SITIOS_LOAD_METHOD', default=LOAD_METHOD)
+
+# Stable row keys of tables that can be loaded incrementally
+# (domicilio tells apart same name sites of a locality)
+UPSERT_KEYS = {'sitios': ['categoria', 'cod_localidad', 
+                          'nombre', 'domicilio']}
+
+# Indexes created after each load, one list of columns per 
+# index. Tables can be clustered on their first one (the 
+# dominant filter), see CLUSTER_TABLES setting
+TABLE_INDEXES = {'sitios': [['provincia'], 
+                            ['categoria'], 
+                            ['cod_localidad']],
+                 'cines': [['butacas']]}
+CLUSTER_TABLES = config('CLUSTER_TABLES', default=False, cast=bool)
+
+# Where totales and cines are aggregated: pandas (client side 
+# tables) or database (materialized views over source tables)
+AGGREGATION = config('AGGREGATION', default='pandas')
+
+# Materialized views: the sql file defining them, the source table 
+# they read and the columns of it
+MATERIALIZED_VIEWS = {
+    'totales': {'file': 'totales_view.sql',
+                'source': 'totales_source',
+                'columns': ['provincia', 'categoria', 'fuente']},
+    'cines': {'file': 'cines_view.sql',
+              'source': 'cines_source',
+              'columns': ['provincia', 'pantallas', 
+                          'butacas', 'espacio_incaa']}
+    }
+
+# Tables loaded by this module, the only ones whose query
+# results are cached (see sql_file_exec)
+CACHED_TABLES = {'sitios', 'totales', 'cines'} | {
+    spec['source'] for spec in MATERIALIZED_VIEWS.values()}
+
+# Tables named by a sql statement, and statements whose results
+# can be cached (reads only)
+_TABLE_NAMES = re.compile(
+    r'\b(?:from|join|update|into)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)', 
+    re.IGNORECASE)
+# FROM and JOIN lists, up to the clause that follows them
+_FROM_ITEMS = re.compile(
+    r'\b(?:from|join)\s+(.*?)(?=\b(?:where|group|order|limit|offset|'
+    r'having|window|union|intersect|except|on|using|join|inner|left|'
+    r'right|full|cross|natural|lateral|for|fetch)\b|[();]|$)', 
+    re.IGNORECASE | re.DOTALL)
+_READ_ONLY = re.compile(r'^\s*(?:select|with)\b', re.IGNORECASE)
+_WRITES = re.compile(
+    r'\b(?:insert|update|delete|merge|create|drop|alter|truncate|refresh)\b', 
+    re.IGNORECASE)
+
+# Shared engines (one connection pool per url), created lazily
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
 
 # Configuring loggings
 log_settings()
 
-def create_database():
+def get_engine(url:str=DB_URL) -> Engine:
+    """Returns the shared engine for a database url.
+    It is created on first use and reused afterwards, so
+    every call borrows a connection from the same pool.
+
+    Args:
+        url (str): Defaults to DB_URL. Use ENGINE_URL for 
+        server level statements (e.g. CREATE DATABASE).
+
+    Returns:
+        A sqlalchemy.engine.Engine
+    """
+    engine = _ENGINES.get(url)
+    if engine is None:
+        with _ENGINES_LOCK:
+            engine = _ENGINES.get(url)
+            if engine is None:
+                engine = create_engine(url,
+                                       isolation_level='AUTOCOMMIT',
+                                       pool_size=POOL_SIZE,
+                                       max_overflow=MAX_OVERFLOW,
+                                       pool_pre_ping=POOL_PRE_PING,
+                                       pool_recycle=POOL_RECYCLE)
+                _ENGINES[url] = engine
+    return engine
+
+def dispose() -> None:
+    """Closes every pooled connection and forgets the shared engines.
+    The next call to get_engine() creates a new one."""
+    with _ENGINES_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+    log.info('Database connection pools disposed')
+
+@functools.lru_cache(maxsize=None)
+def read_sql_file(path:str) -> str:
+    """Reads a sql script file. Files are read from disk 
+    only once and kept in memory afterwards.
+
+    Args:
+        path (str): Path of the sql script file.
+
+    Returns:
+        The sql script text
+    """
+    with open(path) as file:
+        return file.read()
+
+def _sql(filename:str, **templates) -> str:
+    """Returns a script of the project sql folder with its
+    {templates} filled in"""
+    query = read_sql_file(os.path.join(SQL_DIR, filename))
+    return query.format(**templates) if templates else query
+
+@metrics.instrument
+def create_database() -> int:
     """Creates a new database in postgresql.
     The database name is retreived from settings.ini file
+
+    Returns:
+        The database oid, which changes whenever the database
+        is created again (so stages loading it are rerun)
     """
     try:
         # Checks if database already exists
-        with create_engine(ENGINE_URL,
-                        isolation_level='AUTOCOMMIT'
-                        ).connect() as conn:
-            file = open('sql\\db_exists.sql')
-            query = file.read().format(
-                db_name=DB_NAME)
-            file.close()
-            exists = conn.execute(query).fetchone()
+        with get_engine(ENGINE_URL).connect() as conn:
+            query = _sql('db_exists.sql')
+            exists = conn.execute(text(query), 
+                                  {'db_name': DB_NAME}).fetchone()
             if exists:
                 log.warning(f'{DB_NAME} database already exists')
             # Create database if it does not exist
             else:
-                file = open('sql\\create_db.sql')
-                query = file.read().format(
-                    db_name=DB_NAME)
-                file.close()
-                conn.execute(query)
+                query = _sql('create_db.sql', db_name=DB_NAME)
+                conn.execute(text(query))
                 log.info(f'{DB_NAME} database created')
+                exists = conn.execute(text(_sql('db_exists.sql')), 
+                                      {'db_name': DB_NAME}).fetchone()
+            return exists[0]
     except:
         type, value, traceback = sys.exc_info()
         log.error(f'{type}, {value}')
         sys.exit(1)
 
-def df_to_dbtable(df:pd.DataFrame, table:str='sitios'):
+def _copy_df(conn, df:pd.DataFrame, table:str, index:bool=True) -> None:
+    """Streams a pandas dataframe (index included by default) into an 
+    existing table with COPY FROM STDIN, from an in-memory csv buffer"""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=index, header=False)
+    buffer.seek(0)
+    
+    cols = list(df.columns)
+    if index:
+        cols = [df.index.name or 'index'] + cols
+    query = _sql('copy_from_stdin.sql', tab=table, cols=_quote(cols))
+    
+    # psycopg2 cursor from the underlying DBAPI connection
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(query, buffer)
+    finally:
+        cursor.close()
+
+def _quote(cols:list) -> str:
+    """Returns a comma separated list of quoted column names"""
+    return ', '.join(f'"{col}"' for col in cols)
+
+def _create_table(conn, df:pd.DataFrame, table:str) -> None:
+    """Replaces a table with an empty one, with a fecha_de_carga
+    column filled by default during COPY loads"""
+    # Column types inferred by pandas from the frame 
+    # as to_sql would do
+    schema = pd.io.sql.get_schema(df.reset_index(), table, con=conn)
+    conn.execute(text(f'DROP TABLE IF EXISTS {table}'))
+    conn.execute(text(schema))
+    
+    # Date column filled by its default during COPY
+    query = _sql('add_date_column_default.sql', 
+                 tab=table, 
+                 col='fecha_de_carga')
+    conn.execute(text(query))
+
+def _finish_table(conn, table:str) -> None:
+    """Drops the fecha_de_carga default and sets the primary key,
+    once the table is loaded"""
+    query = _sql('drop_column_default.sql', 
+                 tab=table, 
+                 col='fecha_de_carga')
+    conn.execute(text(query))
+    
+    # Set index as primary key (after the load)
+    query = _sql('add_primary_key.sql', tab=table)
+    conn.execute(text(query))
+
+def _index_table(conn, table:str, cluster:bool=False) -> None:
+    """Creates the TABLE_INDEXES of a loaded table (or view), 
+    optionally clusters it on the first one and updates its 
+    planner statistics"""
+    names = []
+    for cols in TABLE_INDEXES.get(table, []):
+        name = f'{table}_{"_".join(cols)}_idx'
+        conn.execute(text(_sql('create_index.sql', 
+                               name=name, 
+                               tab=table, 
+                               cols=_quote(cols))))
+        names.append(name)
+    
+    # Rows physically ordered by the dominant filter column
+    if cluster and CLUSTER_TABLES and names:
+        conn.execute(text(_sql('cluster_table.sql', 
+                               tab=table, 
+                               name=names[0])))
+        log.info(f'{table} clustered on {names[0]}')
+    
+    conn.execute(text(_sql('analyze_table.sql', tab=table)))
+
+def _load_copy(conn, df:pd.DataFrame, table:str) -> None:
+    """Replaces a table with COPY, filling fecha_de_carga 
+    during the load"""
+    _create_table(conn, df, table)
+    
+    # Bulk load
+    _copy_df(conn, df, table)
+    
+    _finish_table(conn, table)
+
+def _load_insert(conn, df:pd.DataFrame, table:str) -> None:
+    """Replaces a table with pandas to_sql and sets 
+    fecha_de_carga afterwards"""
+    # pandas df to new db table
+    df.to_sql(table, con=conn, if_exists='replace')
+    
+    # Set index as primary key
+    query = _sql('add_primary_key.sql', tab=table)
+    conn.execute(text(query))
+    
+    # Add date column
+    query = _sql('add_date_column.sql', 
+                 tab=table, 
+                 col='fecha_de_carga')
+    conn.execute(text(query))
+
+def _key_index(key:list) -> str:
+    """Returns the expressions of the unique key index of a table.
+    Null key values are indexed as '', so ON CONFLICT matches rows
+    with null keys too, as the deletes (IS NOT DISTINCT FROM) do"""
+    return ', '.join(f'COALESCE("{col}"::text, \'\')' for col in key)
+
+def _has_key_index(conn, table:str) -> bool:
+    """Checks if a table has the unique key index of upserts"""
+    query = _sql('index_exists.sql')
+    params = {'tab': table, 'name': f'{table}_upsert_keys'}
+    return conn.execute(text(query), params).fetchone() is not None
+
+def _load_upsert(conn, df:pd.DataFrame, table:str) -> None:
+    """Applies only the rows inserted, updated or deleted since the 
+    previous load of a table, diffing row hashes against the
+    snapshot saved by that load. Tables with repeated keys are
+    fully loaded instead, as with COPY, so no row is left out"""
+    key = UPSERT_KEYS[table]
+    
+    # One row per key, as ON CONFLICT needs
+    duplicated = df.duplicated(subset=key).sum()
+    if duplicated:
+        log.warning(f'{duplicated} rows with repeated {key} in {table}, '
+                    'fully loaded instead of upserted')
+        _load_copy(conn, df, table)
+        cache.forget_table_snapshot(table)
+        return
+    
+    # Keys and row hashes are kept to diff with the next load
+    row_hash = pd.util.hash_pandas_object(df, index=False)
+    snapshot = df[key].reset_index(drop=True)
+    snapshot['_row_hash'] = row_hash.values
+    
+    previous = cache.load_table_snapshot(table)
+    table_columns = set()
+    if inspect(conn).has_table(table):
+        table_columns = {col['name'] for col in 
+                         inspect(conn).get_columns(table)}
+    if (previous is None or list(previous.columns[:-1]) != key
+            or not set(df.columns) <= table_columns
+            or not _has_key_index(conn, table)):
+        # First load (or new columns or key): full COPY, then 
+        # the unique key for upserts
+        _load_copy(conn, df.reset_index(drop=True), table)
+        conn.execute(text(_sql('create_unique_index.sql', 
+                               tab=table, 
+                               cols=_key_index(key))))
+        cache.save_table_snapshot(table, snapshot)
+        log.info(f'{table} fully loaded ({len(df)} rows)')
+        return
+    
+    # Rows whose content is new, and keys no longer present
+    changed = df[~row_hash.isin(previous['_row_hash']).values]
+    key_hash = pd.util.hash_pandas_object(df[key], index=False)
+    previous_key_hash = pd.util.hash_pandas_object(previous[key], 
+                                                   index=False)
+    deleted_keys = previous.loc[~previous_key_hash.isin(key_hash).values, 
+                                key]
+    
+    stage = f'{table}_stage'
+    deleted = f'{table}_deleted'
+    cols = list(df.columns)
+    match = ' AND '.join(f't."{col}" IS NOT DISTINCT FROM s."{col}"' 
+                         for col in key)
+    updates = ', '.join(f'"{col}" = EXCLUDED."{col}"' 
+                        for col in cols + ['fecha_de_carga'] 
+                        if col not in key)
+    
+    # A connection of its own: the isolation level is set on the
+    # DBAPI connection, and conn has to stay in autocommit
+    tx_engine = get_engine().execution_options(
+        isolation_level='READ COMMITTED')
+    with tx_engine.begin() as tx_conn:
+        if len(deleted_keys):
+            tx_conn.execute(text(_sql('create_staging_table.sql', 
+                                      stage=deleted, tab=table)))
+            _copy_df(tx_conn, deleted_keys, deleted, index=False)
+            tx_conn.execute(text(_sql('delete_from_staging.sql', 
+                                      tab=table, stage=deleted, 
+                                      match=match)))
+        if len(changed):
+            tx_conn.execute(text(_sql('create_staging_table.sql', 
+                                      stage=stage, tab=table)))
+            _copy_df(tx_conn, changed, stage, index=False)
+            tx_conn.execute(text(_sql('upsert_from_staging.sql', 
+                                      tab=table, stage=stage, 
+                                      cols=_quote(cols), 
+                                      key=_key_index(key), 
+                                      updates=updates)))
+    
+    cache.save_table_snapshot(table, snapshot)
+    log.info(f'{table} incrementally loaded: {len(changed)} rows '
+             f'inserted or updated, {len(deleted_keys)} deleted')
+
+def _matview_exists(conn, view:str) -> bool:
+    """Checks if a materialized view exists"""
+    query = _sql('matview_exists.sql')
+    return conn.execute(text(query), {'view': view}).fetchone() is not None
+
+@metrics.instrument
+def df_to_dbtable(df:pd.DataFrame, table:str='sitios', method:str=None):
     """Creates a new table in database from a pandas dataframe.
-    If exists previously it gets replaced.
+    If exists previously it gets replaced. TABLE_INDEXES of the
+    table are created after the load, and the table analyzed.
     
     Args:
         df (pandas.DataFrame)
         table (str): The name of the new table (Default: sitios)
+        method (str, optional): 'copy' streams rows with postgresql
+        COPY and fills fecha_de_carga during the load. 'insert' uses 
+        pandas to_sql and a later UPDATE. 'upsert' (only for tables 
+        in UPSERT_KEYS) keeps the table and applies just the rows
+        inserted, updated or deleted since the previous load, through 
+        a staging table and INSERT ... ON CONFLICT. Defaults to 
+        LOAD_METHOD setting.
         """
+    if method is None:
+        method = LOAD_METHOD
     try:
-        with create_engine(DB_URL, 
-                        isolation_level='AUTOCOMMIT'
-                        ).connect() as conn:
+        if method == 'upsert' and table not in UPSERT_KEYS:
+            raise ValueError(f'{table} has no key for upsert loading')
+        
+        with get_engine().connect() as conn:
             
             # Drop 'fuente' column if table=sitios
             if table=='sitios':
                 df = df.drop(columns='fuente')
             
-            # pandas df to new db table
-            df.to_sql(table, con=conn, if_exists='replace')
+            # A materialized view of a previous run takes the name
+            if _matview_exists(conn, table):
+                conn.execute(text(_sql('drop_matview.sql', view=table)))
+            
+            if method == 'upsert':
+                _load_upsert(conn, df, table)
+            elif method == 'copy':
+                _load_copy(conn, df, table)
+            else:
+                _load_insert(conn, df, table)
             
-            # Set index as primary key
-            file = open('sql\\add_primary_key.sql')
-            query = file.read().format(
-                tab=table)
-            file.close()
-            conn.execute(text(query))
+            # Indexes built once the rows are in, and statistics.
+            # Upserted tables are kept in use, so not clustered
+            _index_table(conn, table, cluster=method != 'upsert')
             
-            # Add date column
-            file = open('sql\\add_date_column.sql')
-            query = file.read().format(
-                tab=table, 
-                col='fecha_de_carga')
-            conn.execute(text(query))
-            file.close()
+            # A replaced table can not be diffed with its old snapshot
+            if method != 'upsert':
+                cache.forget_table_snapshot(table)
+            # Cached query results of the table are no longer used
+            cache.bump_generation(table)
             log.info(f'{table} table added in {DB_NAME} database')
     except:
         type, value, traceback = sys.exc_info()
         log.error(f'{type}, {value}')
         sys.exit(1)           
 
-def sql_file_exec(path:str,**params) -> pd.DataFrame:
+@metrics.instrument
+def df_chunks_to_dbtable(chunks, table:str='sitios') -> int:
+    """Creates a new table in database from an iterator of pandas 
+    dataframe chunks, copying each chunk with COPY as it arrives, 
+    so only one chunk is held in memory at a time.
+    If exists previously it gets replaced. 
+    
+    Column types are taken from the first chunk.
+    
+    Args:
+        chunks (iterable of pandas.DataFrame)
+        table (str): The name of the new table (Default: sitios)
+    
+    Returns:
+        The number of rows loaded
+    """
+    try:
+        rows = 0
+        with get_engine().connect() as conn:
+            for chunk in chunks:
+                # Drop 'fuente' column if table=sitios
+                if table=='sitios':
+                    chunk = chunk.drop(columns='fuente')
+                
+                # Index continues across chunks
+                chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                if rows == 0:
+                    _create_table(conn, chunk, table)
+                _copy_df(conn, chunk, table)
+                rows += len(chunk)
+            
+            if rows:
+                _finish_table(conn, table)
+                _index_table(conn, table, cluster=True)
+                cache.forget_table_snapshot(table)
+                cache.bump_generation(table)
+                log.info(f'{table} table added in {DB_NAME} database '
+                         f'({rows} rows)')
+            else:
+                log.warning(f'No rows to load in {table} table')
+        return rows
+    except:
+        type, value, traceback = sys.exc_info()
+        log.error(f'{type}, {value}')
+        sys.exit(1)
+
+@metrics.instrument
+def df_to_matview(df:pd.DataFrame, view:str) -> None:
+    """Loads the source table of a materialized view (see 
+    MATERIALIZED_VIEWS) from a pandas dataframe and refreshes
+    the view, so it is aggregated in the database. 
+    
+    The view is created on the first load (replacing a table of 
+    the same name) and refreshed concurrently afterwards, so
+    readers of it are not blocked during the refresh.
+    
+    Args:
+        df (pandas.DataFrame): The dataframe the pandas version 
+        of the view is computed from, e.g. the one generated by 
+        download_datasets() for 'totales' or by csv_to_df() for
+        'cines'. Column names are case insensitive.
+        view (str): 'totales' or 'cines'
+    """
+    try:
+        spec = MATERIALIZED_VIEWS[view]
+        source = spec['source']
+        
+        # Source columns as text, nulls kept; the view 
+        # parses and cleans them as pandas does
+        df = df.rename(columns=str.lower)[spec['columns']]
+        df = df.astype('string')
+        
+        # Source reload on a connection of its own, so the
+        # connection running the refresh stays in autocommit
+        tx_engine = get_engine().execution_options(
+            isolation_level='READ COMMITTED')
+        with tx_engine.begin() as tx_conn:
+            if inspect(tx_conn).has_table(source):
+                # Emptied, as the view depends on it
+                tx_conn.execute(text(_sql('truncate_table.sql', 
+                                          tab=source)))
+            else:
+                schema = pd.io.sql.get_schema(df.reset_index(), 
+                                              source, 
+                                              con=tx_conn)
+                tx_conn.execute(text(schema))
+            _copy_df(tx_conn, df, source)
+        
+        with get_engine().connect() as conn:
+            if _matview_exists(conn, view):
+                conn.execute(text(_sql('refresh_matview.sql', 
+                                       view=view)))
+                _index_table(conn, view)
+                log.info(f'{view} materialized view refreshed')
+            else:
+                conn.execute(text(f'DROP TABLE IF EXISTS {view}'))
+                conn.execute(text(_sql(spec['file'], 
+                                       view=view, 
+                                       source=source)))
+                # Unique index, needed to refresh concurrently
+                conn.execute(text(_sql('create_matview_index.sql', 
+                                       view=view)))
+                _index_table(conn, view, cluster=True)
+                log.info(f'{view} materialized view added in '
+                         f'{DB_NAME} database')
+            cache.bump_generation(source)
+            cache.bump_generation(view)
+    except:
+        type, value, traceback = sys.exc_info()
+        log.error(f'{type}, {value}')
+        sys.exit(1)
+
+def _table_name(name:str) -> str:
+    """Lower case table name, without quotes nor the public schema
+    (other schemas are kept, so they never match a loaded table)"""
+    name = name.replace('"', '').lower()
+    return name[len('public.'):] if name.startswith('public.') else name
+
+def _query_tables(query:str) -> set:
+    """Returns the names of the tables a sql statement reads or writes,
+    also the ones of comma separated FROM lists. Items that are not
+    plain table names (subqueries, functions) are returned as ''"""
+    tables = {_table_name(name) for name in _TABLE_NAMES.findall(query)}
+    for items in _FROM_ITEMS.findall(query):
+        for item in items.split(','):
+            name = re.match(r'\s*((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)', 
+                            item)
+            tables.add(_table_name(name.group(1)) if name else '')
+    return tables
+
+def _cacheable(tables:set) -> bool:
+    """Whether results of a read of tables can be cached: only when
+    every table it reads is loaded by this module, so loads bump its
+    generation. Reads of no table (e.g. 'select now()'), of system
+    catalogs or of tables loaded elsewhere are not cached"""
+    return bool(tables) and tables <= CACHED_TABLES
+
+def _stream_query(query:str, bind_params:dict, chunksize:int):
+    """Yields query results as pandas dataframes of chunksize rows,
+    fetched through a server-side cursor"""
+    try:
+        with get_engine().connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                text(query), bind_params)
+            columns = list(result.keys())
+            log.info('Query executed, streaming results')
+            log.info(query.center(20))
+            while True:
+                rows = result.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=columns)
+    
+    # Not GeneratorExit, raised when the chunks are not all read
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        log.error(f'{type}, {value}')
+        sys.exit(1)
+
+@metrics.instrument
+def sql_file_exec(path:str, 
+                  bind_params:dict=None, 
+                  chunksize:int=None, 
+                  **params) -> pd.DataFrame:
     """Executes any SQL script file.
     If there is a query result, 
     it is returned as a pandas dataframe.
+    The statement is executed only once and the file
+    is read from disk only the first time. Results of 
+    SELECT statements reading only the tables loaded by this 
+    module (CACHED_TABLES) are cached (see QUERY_CACHE settings)
+    until one of the tables they read is loaded again.
     
     Args:
         path (str): Path of the sql script file.
+        bind_params (dict, optional): values for :name bound 
+        parameters of the script. Values should be passed this 
+        way, so the database can reuse the query plan.
+        chunksize (int, optional): if given, an iterator of 
+        pandas dataframes of chunksize rows is returned instead,
+        fetched with a server-side cursor.
         **params: if the script file has {params},
         they can be passed as consequent arguments.
+        Meant for identifiers such as table names.
         
         IMPORTANT: params in .sql file need to be 
         surrounded by curly braces {}
         
     Result: 
-        A pandas.DataFrame
+        A pandas.DataFrame (or an iterator of them)
     
     Use example:
     
-    sql_file_exec('script.sql', table=users, col=name)
+    sql_file_exec('script.sql', {'min': 10}, table=users, col=name)
     """
     try:
-        with create_engine(DB_URL, 
-                        isolation_level='AUTOCOMMIT'
-                        ).connect() as conn:
-            file = open(path)
-            if params:
-                query = file.read().format(**params)
-            else:
-                query = file.read()
-            file.close()
-            result = conn.execute(text(query))
-            if result:
-                df = pd.read_sql_query(sql=query, con=conn)
+        query = read_sql_file(path)
+        if params:
+            query = query.format(**params)
+        bind_params = bind_params or {}
+        
+        if chunksize:
+            return _stream_query(query, bind_params, chunksize)
+        
+        # Results of reads are cached until a table they 
+        # read is loaded again
+        tables = _query_tables(query)
+        read_only = _READ_ONLY.match(query) and not _WRITES.search(query)
+        cached = cache.QUERY_CACHE and read_only and _cacheable(tables)
+        if cached:
+            key = cache.result_key(query, bind_params, tables)
+            df = cache.load_result(key)
+            if df is not None:
+                log.info('Query result taken from cache')
+                return df
+        
+        with get_engine().connect() as conn:
+            result = conn.execute(text(query), bind_params)
+            if result.returns_rows:
+                df = pd.DataFrame(result.fetchall(), 
+                                  columns=list(result.keys()))
                 msg = 'Query executed and saved into pandas dataframe'
                 log.info(msg)
                 log.info(query.center(20))
-                return df
             else:
+                df = None
                 log.info(f'Query executed')
                 log.info(query.center(20))
+        
+        if not read_only:
+            # Tables the statement may have changed
+            for table in tables - {''}:
+                cache.bump_generation(table)
+        elif cached and df is not None:
+            cache.save_result(key, df)
+        return df
                 
     except:
         type, value, traceback = sys.exc_info()
@@ -142,10 +678,9 @@ if __name__=='__main__':
     create_database()
     create_database()
     
-    with create_engine(
-        ENGINE_URL,
-        isolation_level='AUTOCOMMIT'
-        ).connect() as conn:
+    # Release the pool on cultura before dropping it
+    dispose()
+    with get_engine(ENGINE_URL).connect() as conn:
     
         conn.execute(f'drop database {DB_NAME}')
         log.info(f'{DB_NAME} database deleted')
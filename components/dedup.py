@@ -0,0 +1,206 @@
+"""This module removes repeated sites from the sitios dataframe
+(concatenated by df_concat() of dataframe_processor module), within
+a dataset or across datasets, before it is loaded and counted.
+
+Sites are matched by hashes, never by comparing pairs of rows:
+    - exact duplicates share a key made from the normalized
+      'nombre', 'domicilio' and 'cod_localidad'
+    - near duplicates share 'cod_localidad' (the block) and
+      'categoria', and have the same words in 'nombre' and in
+      'domicilio' (or no domicilio both), in any order and with or
+      without accents, punctuation, case or stopwords
+Rows sharing either key are one cluster. Both keys are hashed and
+grouped in linear time. Near matching is an identical bag of words:
+there is no similarity measure within a block, so misspelled or
+abbreviated names ('Bca.' for 'Biblioteca') are not matched."""
+
+from decouple import config
+from components.logs_config import log, log_settings
+import components.metrics as metrics
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+# Whether script.py deduplicates sitios, and the csv report of
+# merged clusters (empty to disable it)
+DEDUPLICATE = config('DEDUPLICATE', default=True, cast=bool)
+DEDUP_REPORT = config('DEDUP_REPORT', default='duplicates.csv')
+
+# Words left out of name signatures
+STOPWORDS = ['de', 'del', 'la', 'las', 'el', 'los', 'y', 'e', 'a', 'al']
+
+ACCENTS = re.compile(r'[\u0300-\u036f]')
+NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+# Columns in the duplicates report
+REPORT_COLUMNS = ['categoria', 'cod_localidad', 'nombre', 'domicilio']
+
+# Configuring loggings
+log_settings()
+
+def _normalize_text(col:pd.Series) -> pd.Series:
+    """Lower case words without accents nor punctuation,
+    single spaced"""
+    text = col.astype('string').str.normalize('NFKD')
+    text = text.str.replace(ACCENTS, '', regex=True).str.lower()
+    return text.str.replace(NON_ALNUM, ' ', regex=True).str.strip()
+
+def exact_keys(df:pd.DataFrame) -> np.ndarray:
+    """Hashes of the normalized 'nombre', 'domicilio' and
+    'cod_localidad' of every row
+
+    Args:
+        df (pandas.DataFrame)
+
+    Returns:
+        A numpy array of uint64
+    """
+    keys = pd.DataFrame({'nombre': _normalize_text(df['nombre']),
+                         'domicilio': _normalize_text(df['domicilio']),
+                         'cod_localidad': df['cod_localidad']})
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+def name_signatures(names:pd.Series) -> np.ndarray:
+    """Order independent hashes of the distinct words of names,
+    stopwords excluded. Names without words get 0.
+
+    Args:
+        names (pandas.Series)
+
+    Returns:
+        A numpy array of uint64, one per name
+    """
+    words = _normalize_text(names).reset_index(drop=True).str.split()
+    words = words.explode().dropna()
+    words = words[~words.isin(STOPWORDS)]
+
+    # One row per distinct word of each name, in name order
+    words = words.reset_index().drop_duplicates()
+    rows = words['index'].to_numpy()
+    hashes = pd.util.hash_pandas_object(words.iloc[:, 1],
+                                        index=False).to_numpy()
+
+    # Sum of the word hashes of each name (wrapping uint64)
+    signatures = np.zeros(len(names), dtype='uint64')
+    if len(rows):
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        signatures[rows[starts]] = np.add.reduceat(hashes, starts)
+    return signatures
+
+def clusters(df:pd.DataFrame) -> pd.DataFrame:
+    """Groups the rows of a sitios dataframe into clusters of
+    duplicates: rows sharing the exact or the near key, directly
+    or through other rows. Rows without 'cod_localidad' or name 
+    words can only be exact duplicates. Near duplicates also need
+    the same 'categoria' and 'domicilio' words, so different sites
+    with the same name in a locality are not merged, while exact
+    duplicates are merged across categories.
+
+    Args:
+        df (pandas.DataFrame)
+
+    Returns:
+        A pandas.DataFrame with the same index and columns:
+            -'cluster': position of the first row of the cluster\n
+            -'size': rows in the cluster\n
+            -'match': 'exact' or 'near' (to the first row)
+    """
+    exact = exact_keys(df)
+    signatures = name_signatures(df['nombre'])
+    blocked = df['cod_localidad'].notna().to_numpy() & (signatures != 0)
+
+    # Near key (block, category, name and address signatures)
+    near = pd.util.hash_pandas_object(
+        pd.DataFrame({'cod_localidad': df['cod_localidad'].to_numpy(),
+                      'categoria': df['categoria'].astype('string'
+                                                          ).to_numpy(),
+                      'signature': signatures,
+                      'domicilio': name_signatures(df['domicilio'])}), 
+        index=False).to_numpy()
+    exact_codes = pd.factorize(exact)[0]
+    near_codes = pd.factorize(near)[0]
+    # Rows without near key only match exactly
+    near_codes[~blocked] = -1 - np.arange((~blocked).sum())
+
+    # Union of both groupings: every row takes the lowest 
+    # position of its groups until no row changes
+    cluster = np.arange(len(df))
+    while True:
+        merged = cluster
+        for codes in (exact_codes, near_codes):
+            merged = pd.Series(merged).groupby(codes).transform(
+                'min').to_numpy()
+        if (merged == cluster).all():
+            break
+        cluster = merged
+
+    match = np.where(exact == exact[cluster], 'exact', 'near')
+    return pd.DataFrame({'cluster': cluster,
+                         'size': np.bincount(cluster, 
+                                             minlength=len(df))[cluster],
+                         'match': match},
+                        index=df.index)
+
+def _save_report(report:pd.DataFrame, path:str) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    report.to_csv(path, index=False)
+    log.info(f'Duplicates report saved in {path}')
+
+@metrics.instrument
+def deduplicate(df:pd.DataFrame, report_path:str=None) -> pd.DataFrame:
+    """Keeps one row per cluster of duplicates (the first one),
+    with its nulls filled from the other rows of the cluster.
+    The rows of merged clusters are listed in a csv report.
+    The input dataframe is not modified.
+
+    Args:
+        df (pandas.DataFrame): Has to be a pandas dataframe
+        generated from download_datasets() function of
+        downloader module.
+        report_path (str, optional): Csv report path.
+        Defaults to DEDUP_REPORT setting.
+
+    Returns:
+        A pandas.DataFrame, with a new index
+    """
+    if report_path is None:
+        report_path = DEDUP_REPORT
+    try:
+        found = clusters(df)
+        repeated = (found['size'] > 1).to_numpy()
+        first = (found['cluster'].to_numpy()
+                 == np.arange(len(df)))
+
+        final_df = df[first]
+        if repeated.any():
+            # First non null value of every column in each cluster,
+            # put back in place of the first row of the cluster
+            members = df[repeated]
+            merged = members.groupby(found['cluster'][repeated].to_numpy(),
+                                     sort=False).first()
+            positions = np.concatenate([np.flatnonzero(~repeated), 
+                                        merged.index.to_numpy()])
+            merged.index = df.index[merged.index]
+            final_df = pd.concat([df[~repeated], merged[df.columns]])
+            final_df = final_df.iloc[np.argsort(positions, kind='stable')]
+
+            report = found[repeated].assign(
+                fila=np.flatnonzero(repeated),
+                **{col: members[col] for col in REPORT_COLUMNS
+                   if col in members.columns})
+            report = report.sort_values(['cluster', 'fila'],
+                                        kind='stable')
+            if report_path:
+                _save_report(report, report_path)
+
+        log.info(f'{len(df) - len(final_df)} duplicated sites removed '
+                 f'({(first & repeated).sum()} clusters merged)')
+
+        return final_df.reset_index(drop=True)
+
+    except:
+        typ, value, traceback = sys.exc_info()
+        log.error(f'{typ}, {value}')
+        sys.exit(1)
@@ -5,72 +5,268 @@ import requests
 from decouple import config
 from components.logs_config import log, log_settings
 import components.dataframe_processor as proc
+import components.cache as cache
+import components.snapshots as snapshots
+import components.metrics as metrics
 import sys
 import datetime
 import locale
 import os
 import pandas as pd
+import threading
+import json
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
 
 QUERY_STRING = config('QUERY_STRING')[1:-1]
 API_URL = config('API_URL')[1:-1]
-DATASETS = [
-    {
-        'name' : config('DATASET_1_NAME')[1:-1],
-        'resource_id' : config('DATASET_1_ID')[1:-1]
-        },
-    {
-        'name' : config('DATASET_2_NAME')[1:-1],
-        'resource_id' : config('DATASET_2_ID')[1:-1]
-        },
-    {
-        'name' : config('DATASET_3_NAME')[1:-1],
-        'resource_id' : config('DATASET_3_ID')[1:-1]
-        }
-    ]
+DATASETS_FILE = config('DATASETS_FILE', default='datasets.json')
+MAX_WORKERS = config('MAX_WORKERS', default=4, cast=int)
+PAGE_SIZE = config('PAGE_SIZE', default=10000, cast=int)
+REQUEST_TIMEOUT = config('REQUEST_TIMEOUT', default=60, cast=int)
+CHUNK_SIZE = config('CHUNK_SIZE', default=0, cast=int)
+USE_CACHE = config('USE_CACHE', default=True, cast=bool)
+SNAPSHOT_FORMAT = config('SNAPSHOT_FORMAT', default='csv')
+SNAPSHOT_COMPRESSION = config('SNAPSHOT_COMPRESSION', default='zstd')
+
+NORMALIZE_PROCESSES = config('NORMALIZE_PROCESSES', default=0, cast=int)
+
+# Raw dataframes kept in memory for later steps (see csv_to_df)
+HANDOFF_DATASETS = ['Salas de cine']
+
+# setlocale() is process-wide and not thread safe
+_LOCALE_LOCK = threading.Lock()
 
 # Configuring loggings
 log_settings()
 
-def api_to_df(dataset:dict) -> pd.DataFrame:
-    """Downloads a dataset from datos.gob.ar CKAN API 
-    and saves it into a pandas dataframe
+def load_registry(path:str=DATASETS_FILE) -> list:
+    """Loads the registry of datasets to download from a json file.
+    Each entry has the dataset 'name' and CKAN 'resource_id', and 
+    optionally the column 'renames' and 'transforms' applied by
+    normalize() of dataframe_processor module.
+
+    Args:
+        path (str): Json file path, relative to this module folder
+        unless absolute. Defaults to DATASETS_FILE setting.
+
+    Returns:
+        A list of dicts
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    with open(path, encoding='utf-8') as file:
+        datasets = json.load(file)
+    for dataset in datasets:
+        if not {'name', 'resource_id'} <= dataset.keys():
+            raise ValueError(f'{dataset} needs name and resource_id')
+    return datasets
+
+DATASETS = load_registry()
+
+def _fetch_page(session:requests.Session, 
+                dataset:dict, 
+                offset:int, 
+                limit:int
+                ) -> dict:
+    """Requests one page of a CKAN datastore_search resource.
+    The json response is parsed only once.
+    
+    Returns:
+        The 'result' dictionary of the CKAN response
+    """
+    url = API_URL + QUERY_STRING + dataset['resource_id']
+    response = session.get(url, 
+                           params={'limit': limit, 'offset': offset},
+                           timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    metrics.count_bytes(len(response.content))
+    return response.json()['result']
+
+def _page_to_df(result:dict, columns_order:list) -> pd.DataFrame:
+    """Creates a pandas dataframe from a CKAN result page"""
+    return pd.DataFrame(result['records'], columns=columns_order)
+
+def api_to_chunks(dataset:dict, 
+                  page_size:int=None, 
+                  parallel:bool=False, 
+                  workers:int=None):
+    """Downloads a dataset from datos.gob.ar CKAN API page by page,
+    using limit and offset parameters, and yields each page as a
+    pandas dataframe. Peak memory is bounded by page_size.
 
     Args:
         dataset (dict): Has to be a dictionary retrieved from
         DATASETS variable list from this module.
+        page_size (int, optional): Records per request.
+        Defaults to PAGE_SIZE setting.
+        parallel (bool): If True, once the total is known the 
+        remaining pages are requested concurrently. Pages are 
+        still yielded in order. Defaults to False.
+        workers (int, optional): Number of concurrent requests
+        when parallel is True. Defaults to MAX_WORKERS setting.
         
-    Returns: 
-        A pandas.DataFrame
+    Yields:
+        pandas.DataFrame chunks
+    """
+    if page_size is None:
+        page_size = PAGE_SIZE
+    if workers is None:
+        workers = MAX_WORKERS
+    name = dataset['name'].replace(' ', '_').lower()
+    
+    try:
+        with requests.Session() as session:
+            # First page gives the field order and the total
+            first = _fetch_page(session, dataset, 0, page_size)
+            columns_order = [item['id'] for item in first['fields']]
+            total = first.get('total', len(first['records']))
+            yield _page_to_df(first, columns_order)
+            del first
+            
+            offsets = range(page_size, total, page_size)
+            
+            if not parallel or workers <= 1:
+                for offset in offsets:
+                    page = _fetch_page(session, dataset, offset, page_size)
+                    yield _page_to_df(page, columns_order)
+            else:
+                # Sliding window of requests, so at most 'workers'
+                # pages are held in memory at the same time
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pending = deque()
+                    for offset in offsets:
+                        pending.append(executor.submit(
+                            metrics.bind(_fetch_page), session, 
+                            dataset, offset, page_size))
+                        if len(pending) >= workers:
+                            page = pending.popleft().result()
+                            yield _page_to_df(page, columns_order)
+                    while pending:
+                        page = pending.popleft().result()
+                        yield _page_to_df(page, columns_order)
+        
+        log.info(f'{name} dataset downloaded ({total} records)')
+    
+    # Not GeneratorExit, raised when the chunks are not all read
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        log.error(f'{type}, {value}')
+        sys.exit(1)
+
+@metrics.instrument
+def check_resource(dataset:dict, headers:dict=None) -> dict:
+    """Makes a cheap conditional request (a single record) 
+    to find out if a resource changed upstream.
+
+    Args:
+        dataset (dict): Has to be a dictionary retrieved from
+        DATASETS variable list from this module.
+        headers (dict, optional): Conditional request headers,
+        as returned by cache.conditional_headers()
+
+    Returns:
+        None if the server answered 304 Not Modified, otherwise 
+        a dict with the 'etag' and 'last_modified' validators
     """
     try:
         url = API_URL + QUERY_STRING + dataset['resource_id']
-        response = requests.get(url)
+        response = requests.get(url, 
+                                params={'limit': 1}, 
+                                headers=headers or {},
+                                timeout=REQUEST_TIMEOUT)
+        metrics.count_bytes(len(response.content))
+        if response.status_code == 304:
+            return None
         response.raise_for_status()
-        
-        # access api json response
-        data = response.json()['result']['records']
-        columns_order = [item['id'] for item 
-                         in response.json()['result']['fields']]
-        
-        # DataFrame creation
-        name = dataset['name'].replace(' ', '_').lower()
-        df = pd.DataFrame(data, columns=columns_order)
-        log.info(f'{name} dataset downloaded')
-        
-        return df
+        return {'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
     
     except:
         type, value, traceback = sys.exc_info()
         log.error(f'{type}, {value}')
         sys.exit(1)
+
+@metrics.instrument
+def api_to_df(dataset:dict, 
+              page_size:int=None, 
+              parallel:bool=False
+              ) -> pd.DataFrame:
+    """Downloads a dataset from datos.gob.ar CKAN API 
+    and saves it into a pandas dataframe
+
+    Args:
+        dataset (dict): Has to be a dictionary retrieved from
+        DATASETS variable list from this module.
+        page_size (int, optional): Records per request.
+        Defaults to PAGE_SIZE setting.
+        parallel (bool): If True, pages are requested 
+        concurrently. Defaults to False.
+        
+    Returns: 
+        A pandas.DataFrame
+    """
+    chunks = api_to_chunks(dataset, page_size=page_size, 
+                           parallel=parallel)
+    return pd.concat(chunks, axis=0, ignore_index=True)
         
 
-def df_to_csv(df:pd.DataFrame, dataset:dict) -> None:
+def _set_spanish_locale() -> None:
+    """Sets spanish month names for LC_TIME. 'Spanish_Argentina' 
+    is the Windows locale name; POSIX names are tried next, and 
+    the current locale is kept if none is installed."""
+    for name in ('Spanish_Argentina', 'es_AR.UTF-8', 'es_AR'):
+        try:
+            locale.setlocale(category=locale.LC_TIME, locale=name)
+            return
+        except locale.Error:
+            continue
+    log.warning('Spanish locale not available, using current locale')
+
+def csv_path(dataset:dict) -> str:
+    """Returns the csv snapshot path of a dataset for today,
+    creating its folders if they do not exist:
+    
+    /csv/categoría/año-mes/categoria-dia-mes-año.csv
+    
+    Args:
+        dataset (dict): Has to be a dictionary retrieved from
+        DATASETS variable list from this module.
+    
+    Returns:
+        An absolute path
+    """
+    # Set spanish local formatting for time for folder naming.
+    # Locale is process-wide, so it is guarded by a lock
+    with _LOCALE_LOCK:
+        _set_spanish_locale()
+        _now = datetime.datetime.now()    #Current local time
+        date = f'{_now:%Y}-{_now:%B}'
+        day = f'{_now:%d}-{_now:%B}-{_now:%Y}'
+    name = dataset['name'].replace(' ', '_').lower()
+    filename = f'{name}-{day}.csv'
+    
+    # Create csv/category/date folders if not exist
+    folder = os.path.join(os.getcwd(), 'csv', name, date)
+    os.makedirs(folder, exist_ok=True)
+    
+    return os.path.join(folder, filename)
+
+@metrics.instrument
+def df_to_csv(df:pd.DataFrame, dataset:dict, digest:str=None) -> str:
     """Saves a pandas dataframe into a csv in the following path
     (in argentinean spanish):
     
     /csv/categoría/año-mes/categoria-dia-mes-año.csv
     
+    The path is built from absolute paths, so the process working
+    directory is never changed and several datasets can be saved
+    at the same time from different threads.
+    
+    If SNAPSHOT_FORMAT setting is 'parquet' or 'feather', a typed
+    and compressed columnar copy is saved next to the csv file.
+    
     Args:
         df (pandas.DataFrame): Has to be a pandas dataframe
         returned from api_to_df() function of this module.
@@ -78,52 +274,154 @@ def df_to_csv(df:pd.DataFrame, dataset:dict) -> None:
         category name to be uses as csv filename.
         Has to be a dictionary retrieved from 
         DATASET variable of this module. 
+        digest (str, optional): Content hash of df, recorded in 
+        the category manifest. Computed if not given.
+    
+    Returns:
+        The path of the saved csv file
     """
     try:
-        # Set spanish local formatting for time for folder naming  
-        locale.setlocale(category=locale.LC_TIME, 
-                         locale='Spanish_Argentina')
-        _now = datetime.datetime.now()    #Current local time
         name = dataset['name'].replace(' ', '_').lower()
-        date = f'{_now:%Y}-{_now:%B}'
-        filename = f'{name}-{_now:%d}-{_now:%B}-{_now:%Y}.csv'
-        
-        # Get current directory
-        base_path = os.getcwd()
-        # Create csv folder if not exist
-        csv_path = os.path.join(base_path, 'csv')
+        path = csv_path(dataset)
         
-        if 'csv' not in os.listdir(base_path):
-            os.mkdir('csv')
-        # Change working directory
-        os.chdir(csv_path)
-            
-        # Create category name folder if not exist
-        if name not in os.listdir(csv_path):
-            os.mkdir(name)
-        # Change working directory
-        category_path = os.path.join(csv_path, name)
-        os.chdir(category_path)
-            
-        # Create date folder if not exist
-        if date not in os.listdir(category_path):
-            os.mkdir(date)
-        # Change working directory
-        os.chdir(os.path.join(category_path, date))
-
         # Save dataframe to csv    
-        df.to_csv(filename, index = True)
+        df.to_csv(path, index = True)
+        metrics.count_bytes(os.path.getsize(path), 'written')
         log.info(f'{name} dataset saved to csv')
         
-        # Change working directory to base folder
-        os.chdir(base_path)
+        # Save columnar copy
+        columnar = None
+        if SNAPSHOT_FORMAT in snapshots.COLUMNAR_FORMATS:
+            columnar = snapshots.write_columnar(
+                df, path, 
+                fmt=SNAPSHOT_FORMAT, 
+                compression=SNAPSHOT_COMPRESSION)
+            metrics.count_bytes(os.path.getsize(columnar), 'written')
+            log.info(f'{name} dataset saved to {SNAPSHOT_FORMAT}')
+        
+        snapshots.record(name, path, len(df), 
+                         digest or cache.df_hash(df),
+                         columnar=columnar)
+        
+        return path
     
     except:
         type, value, traceback = sys.exc_info()
         log.error(f'{type}, {value}')
         sys.exit(1)
+
+def api_to_csv_chunks(dataset:dict, page_size:int=None):
+    """Downloads a dataset page by page, appending every page to
+    its csv snapshot as it arrives, and yields the pages. The 
+    snapshot is recorded in the category manifest at the end.
+    Only one page is held in memory at a time.
+
+    Args:
+        dataset (dict): Has to be a dictionary retrieved from
+        DATASETS variable list from this module.
+        page_size (int, optional): Records per page.
+        Defaults to PAGE_SIZE setting.
+
+    Yields:
+        pandas.DataFrame chunks, indexed by record number
+    """
+    name = dataset['name'].replace(' ', '_').lower()
+    path = csv_path(dataset)
+    rows = 0
+    digest = None
+    for chunk in api_to_chunks(dataset, page_size=page_size):
+        # Record numbers continue across chunks
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        if digest is None:
+            digest = cache.hasher(chunk.columns)
+        cache.update_hash(digest, chunk)
+        chunk.to_csv(path, index=True, header=rows == 0, 
+                     mode='w' if rows == 0 else 'a')
+        rows += len(chunk)
+        yield chunk
+    
+    metrics.count_bytes(os.path.getsize(path), 'written')
+    snapshots.record(name, path, rows, digest.hexdigest())
+    log.info(f'{name} dataset saved to csv ({rows} rows)')
+
+@metrics.instrument
+def process_dataset(dataset:dict, 
+                    use_cache:bool=None, 
+                    pool:ProcessPoolExecutor=None
+                    ) -> pd.DataFrame:
+    """Downloads a dataset, saves it into a csv file
+    and returns it normalized.
+    
+    When the cache is enabled and the resource did not change 
+    upstream (304 answer or same content hash), the last csv 
+    snapshot and its normalized dataframe are reused instead,
+    as long as the dataset registry entry and the normalizer
+    did not change either (see normalizer_key() of 
+    dataframe_processor module).
+
+    Args:
+        dataset (dict): Has to be a dictionary retrieved from
+        DATASETS variable list from this module.
+        use_cache (bool, optional): Defaults to USE_CACHE setting.
+        pool (ProcessPoolExecutor, optional): If given, the 
+        normalization runs in it, in another process.
+
+    Returns:
+        A pandas.DataFrame
+    """
+    if use_cache is None:
+        use_cache = USE_CACHE
+    resource_id = dataset['resource_id']
+    name = dataset['name'].replace(' ', '_').lower()
+    entry = cache.load_entry(resource_id) if use_cache else None
+    normalizer = proc.normalizer_key(dataset)
+    if entry and entry.get('normalizer') != normalizer:
+        # Cached frame normalized with other renames, transforms 
+        # or code: downloaded and normalized again
+        log.info(f'{name} normalization changed, cached snapshot not used')
+        entry = None
+    
+    if use_cache:
+        # Cheap conditional request before downloading everything
+        validators = check_resource(dataset, 
+                                    cache.conditional_headers(entry))
+        if entry and validators is None:
+            log.info(f'{name} dataset not modified, using cached snapshot')
+            return cache.load_frame(resource_id)
+    
+    # Download dataset from api and save to pandas dataframe
+    raw_df = api_to_df(dataset)
+    
+    if use_cache:
+        digest = cache.df_hash(raw_df)
+        if entry and entry['hash'] == digest:
+            log.info(f'{name} dataset unchanged, using cached snapshot')
+            entry.update(validators)
+            cache.save_entry(resource_id, entry)
+            return cache.load_frame(resource_id)
+    
+    # Save pandas dataframe to csv and keep it for csv_to_df()
+    csv_path = df_to_csv(raw_df, dataset, 
+                         digest=digest if use_cache else None)
+    if dataset['name'] in HANDOFF_DATASETS:
+        snapshots.hand_over(csv_path, raw_df)
+    
+    # Dataframe normalization
+    if pool is None:
+        norm_df = proc.normalize(raw_df, dataset)
+    else:
+        norm_df = pool.submit(proc.normalize, raw_df, dataset).result()
+    
+    if use_cache:
+        cache.save_entry(resource_id, 
+                         dict(validators, hash=digest, csv_path=csv_path,
+                              normalizer=normalizer),
+                         norm_df)
+    
+    return norm_df
         
-def download_datasets() -> pd.DataFrame:
+@metrics.instrument
+def download_datasets(workers:int=None, processes:int=None) -> pd.DataFrame:
     """This function does the following steps:
     1. Downloads datasets from datos.gob.ar CKAN API
     2. Saves datasets into csv files
@@ -131,26 +429,46 @@ def download_datasets() -> pd.DataFrame:
     4. Normalizes each pandas dataframe
     5. Concatenates each pandas dataframe 
     into one pandas dataframe
+    
+    Steps 1 to 4 run concurrently for every dataset in a
+    thread pool, so csv writes and normalization of one dataset
+    overlap with the downloads still running. Normalization can
+    also be dispatched to a process pool, to use every core.
+
+    Args:
+        workers (int, optional): Number of worker threads.
+        Defaults to MAX_WORKERS setting. 1 runs serially.
+        processes (int, optional): Number of normalization
+        processes. Defaults to NORMALIZE_PROCESSES setting. 
+        0 normalizes in the download threads.
 
     Returns:
         A pandas.DataFrames
     """
-    # An empty list to retrieve the datasets
-    dataset_list = []
-
-    for dataset in DATASETS: # iterate in DATASETS dictionaries list
-
-        # Download dataset from api and save to pandas dataframe
-        raw_df = api_to_df(dataset)
-        
-        # Save pandas dataframe to csv
-        df_to_csv(raw_df, dataset)
-        
-        # Dataframe normalization
-        norm_df = proc.normalize(raw_df, dataset)
-        
-        # Append df to dataset_list
-        dataset_list.append(norm_df)
+    if workers is None:
+        workers = MAX_WORKERS
+    if processes is None:
+        processes = NORMALIZE_PROCESSES
+    
+    pool = None
+    if processes:
+        # Spawned workers: forking while download threads hold
+        # locks (logging, requests) could deadlock the children
+        pool = ProcessPoolExecutor(
+            max_workers=processes, 
+            mp_context=multiprocessing.get_context('spawn'))
+    try:
+        task = functools.partial(process_dataset, pool=pool)
+        if workers <= 1:
+            dataset_list = [task(dataset) for dataset in DATASETS]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # map keeps DATASETS order in the results
+                dataset_list = list(executor.map(metrics.bind(task), 
+                                                 DATASETS))
+    finally:
+        if pool is not None:
+            pool.shutdown()
         
     final_df = proc.df_concat(dataset_list)
         
@@ -1,21 +1,87 @@
 """This module configures logging settings
 For more info visit: https://docs.python.org/3/howto/logging.html
+
+Records are put in a queue by the logging threads and written to
+the log file and console by a single listener thread, so logging
+does not block on I/O in pipeline threads.
 """
 
 
 import logging as log
+import logging.handlers
+import atexit
+import multiprocessing.util
+import os
+import queue
+import threading
+from decouple import config
+
+# Log file, rotated by size (LOG_MAX_BYTES, 0 never rotates)
+LOG_FILE = config('LOG_FILE', default='logs.log')
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+LOG_MAX_BYTES = config('LOG_MAX_BYTES', default=10485760, cast=int)
+LOG_BACKUP_COUNT = config('LOG_BACKUP_COUNT', default=5, cast=int)
+
+LOG_FORMAT = '%(asctime)s: %(levelname)s [%(filename)s:%(lineno)s] %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Queue handler and listener thread, set up once per process
+_HANDLER = None
+_LISTENER = None
+_LOCK = threading.Lock()
+
+def _start_listener(handlers:list) -> None:
+    """Starts a listener thread writing the records of a new
+    queue to handlers"""
+    global _LISTENER
+    records = queue.SimpleQueue()
+    _HANDLER.queue = records
+    _LISTENER = log.handlers.QueueListener(records, *handlers,
+                                           respect_handler_level=True)
+    _LISTENER.start()
+
+def _after_fork() -> None:
+    """Forked processes (e.g. normalization workers) do not
+    inherit the listener thread, so they start their own"""
+    if _LISTENER is not None:
+        _start_listener(_LISTENER.handlers)
+        # Worker processes exit without running atexit functions
+        multiprocessing.util.Finalize(None, stop, exitpriority=0)
+
+def stop() -> None:
+    """Writes the queued records and stops the listener thread"""
+    if _LISTENER is not None and _LISTENER._thread is not None:
+        _LISTENER.stop()
 
 def log_settings():
-    """Sets configuration for logging"""
-    log.basicConfig(level=log.INFO,
-                    format='%(asctime)s: %(levelname)s [%(filename)s:%(lineno)s] %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S',
-                    handlers=[
-                        log.FileHandler('logs.log'),
-                        log.StreamHandler()
-                    ])
+    """Sets configuration for logging.
+    Only the first call in a process configures it"""
+    global _HANDLER
+    with _LOCK:
+        if _HANDLER is not None:
+            return
+
+        formatter = log.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+        handlers = [log.handlers.RotatingFileHandler(
+                        LOG_FILE,
+                        maxBytes=LOG_MAX_BYTES,
+                        backupCount=LOG_BACKUP_COUNT,
+                        encoding='utf-8'),
+                    log.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        _HANDLER = log.handlers.QueueHandler(queue.SimpleQueue())
+        root = log.getLogger()
+        root.setLevel(LOG_LEVEL.upper())
+        root.addHandler(_HANDLER)
+
+        _start_listener(handlers)
+        atexit.register(stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_after_fork)
 
 
 if __name__ == '__main__':
     log_settings()
-    log.info('This is a test messagge')
\ No newline at end of file
+    log.info('This is a test messagge')
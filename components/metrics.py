@@ -0,0 +1,204 @@
+"""This module instruments the pipeline functions. Every call of a
+function decorated with instrument() emits a structured json event 
+with its wall and cpu time (of the process and its finished 
+children), rows in and out, bytes downloaded or written and memory
+figures, through the 'metrics' logger (see logs_config module) 
+and, optionally, to a json lines file.
+Events are also aggregated into a run summary"""
+
+from decouple import config
+from components.logs_config import log, log_settings
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_FILE = config('METRICS_FILE', default='metrics.jsonl')
+TRACE_MEMORY = config('TRACE_MEMORY', default=False, cast=bool)
+
+# Record of the instrumented call running in the current context
+_CURRENT = contextvars.ContextVar('metrics_record', default=None)
+
+# Events of this run, and top level calls measuring tracemalloc peak
+_EVENTS = []
+_LOCK = threading.Lock()
+_ACTIVE = 0
+
+# Configuring loggings
+log_settings()
+metrics_log = log.getLogger('metrics')
+
+def _peak_rss_kb() -> int:
+    """Peak resident set size of the process, in KiB. 
+    None where the resource module is not available"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux KiB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def _children_cpu_s() -> float:
+    """cpu time of the finished child processes (e.g. normalization
+    workers, counted once the pool shuts down). None where the 
+    resource module is not available"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def _rows(obj) -> int:
+    """Rows of a dataframe, or of a list/tuple of dataframes"""
+    if isinstance(obj, pd.DataFrame):
+        return len(obj)
+    if isinstance(obj, (list, tuple)) and obj and all(
+            isinstance(item, pd.DataFrame) for item in obj):
+        return sum(len(item) for item in obj)
+    return None
+
+def count_bytes(n:int, direction:str='downloaded') -> None:
+    """Adds bytes to the instrumented call running in this context.
+
+    Args:
+        n (int): Number of bytes
+        direction (str): 'downloaded' or 'written'
+    """
+    record = _CURRENT.get()
+    if record is not None:
+        key = f'bytes_{direction}'
+        with _LOCK:
+            record[key] = record.get(key, 0) + n
+
+def bind(func):
+    """Returns func running in a copy of the current context, so 
+    work submitted to other threads is counted in the current call"""
+    context = contextvars.copy_context()
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    
+    return wrapper
+
+def emit(event:dict) -> None:
+    """Logs an event as json and appends it to METRICS_FILE"""
+    line = json.dumps(event, default=str)
+    metrics_log.info(line)
+    with _LOCK:
+        _EVENTS.append(event)
+        if METRICS_FILE:
+            with open(METRICS_FILE, 'a') as file:
+                file.write(line + '\n')
+
+def instrument(func):
+    """Decorator measuring every call of a pipeline function"""
+    stage = f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _ACTIVE
+        record = {'event': 'stage', 'stage': stage}
+        rows_in = [_rows(arg) for arg in args]
+        rows_in = [rows for rows in rows_in if rows is not None]
+        if rows_in:
+            record['rows_in'] = sum(rows_in)
+        
+        # tracemalloc peak is process wide: only top level calls
+        # reset and read it
+        trace = TRACE_MEMORY
+        with _LOCK:
+            top = _ACTIVE == 0
+            _ACTIVE += 1
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if top:
+                tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        
+        token = _CURRENT.set(record)
+        # Process cpu time (every thread, so it includes the 
+        # workers a stage fans out to, and calls running 
+        # concurrently in other threads)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children_cpu = _children_cpu_s()
+        status = 'error'
+        try:
+            output = func(*args, **kwargs)
+            status = 'ok'
+            return output
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall, 6)
+            record['cpu_s'] = round(time.process_time() - cpu, 6)
+            if children_cpu is not None:
+                record['children_cpu_s'] = round(
+                    _children_cpu_s() - children_cpu, 6)
+            _CURRENT.reset(token)
+            with _LOCK:
+                _ACTIVE -= 1
+            if status == 'ok':
+                rows_out = _rows(output)
+                if rows_out is not None:
+                    record['rows_out'] = rows_out
+            if trace:
+                current, peak = tracemalloc.get_traced_memory()
+                record['traced_delta_bytes'] = current - traced_before
+                if top:
+                    record['traced_peak_bytes'] = peak - traced_before
+            record['peak_rss_kb'] = _peak_rss_kb()
+            record['status'] = status
+            
+            # Bytes are also counted in the calling stage
+            parent = _CURRENT.get()
+            if parent is not None:
+                with _LOCK:
+                    for key in ('bytes_downloaded', 'bytes_written'):
+                        if key in record:
+                            parent[key] = parent.get(key, 0) + record[key]
+            emit(record)
+    
+    return wrapper
+
+def summary() -> dict:
+    """Aggregates the events of this run by stage.
+
+    Returns:
+        A dict with 'stages' (calls, wall and cpu time, rows, 
+        bytes and memory by stage) and 'peak_rss_kb'
+    """
+    stages = {}
+    with _LOCK:
+        events = list(_EVENTS)
+    for event in events:
+        if event.get('event') != 'stage':
+            continue
+        totals = stages.setdefault(event['stage'], {'calls': 0, 
+                                                    'errors': 0})
+        totals['calls'] += 1
+        totals['errors'] += event['status'] != 'ok'
+        for key in ('wall_s', 'cpu_s', 'children_cpu_s', 'rows_in', 
+                    'rows_out', 'bytes_downloaded', 'bytes_written'):
+            if key in event:
+                totals[key] = round(totals.get(key, 0) + event[key], 6)
+        for key in ('traced_peak_bytes', 'peak_rss_kb'):
+            if event.get(key) is not None:
+                totals[key] = max(totals.get(key, 0), event[key])
+    return {'event': 'summary',
+            'stages': stages,
+            'peak_rss_kb': _peak_rss_kb()}
+
+def log_summary() -> dict:
+    """Emits the run summary as a json event and returns it"""
+    result = summary()
+    emit(result)
+    return result
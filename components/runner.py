@@ -0,0 +1,185 @@
+"""This module runs a pipeline expressed as a graph of stages.
+Each stage output is cached on disk with a fingerprint of the stage
+inputs (the content hashes of its dependencies outputs), so stages
+whose inputs did not change are skipped and a failed run can be
+resumed from the stage that failed.
+
+A pipeline is a dict of stages, in execution order:
+
+    {'name': {'func': callable, 'deps': ['other', ...], 
+              'always': False, 'config': {...}}}
+
+func receives the outputs of deps as positional arguments.
+'config' (json serializable) holds the settings the stage output
+depends on besides its inputs, and is part of its fingerprint, so
+changing them reruns the stage.
+Stages with 'always' set (e.g. downloads, whose inputs live 
+upstream) run on every run; their output hash still lets the
+following stages be skipped. After a failed run, the next run 
+resumes: 'always' stages before the failed one are taken from
+the cache instead of running again."""
+
+from components.logs_config import log, log_settings
+import components.cache as cache
+import hashlib
+import json
+import os
+import pickle
+import pandas as pd
+
+# State key of the stage that failed in the last run
+FAILED = '_failed'
+
+# Configuring loggings
+log_settings()
+
+def _stages_dir() -> str:
+    return os.path.join(os.getcwd(), cache.CACHE_DIR, 'stages')
+
+def _state_path() -> str:
+    return os.path.join(_stages_dir(), 'state.json')
+
+def _load_state() -> dict:
+    if not os.path.exists(_state_path()):
+        return {}
+    with open(_state_path()) as file:
+        return json.load(file)
+
+def _save_state(state:dict) -> None:
+    os.makedirs(_stages_dir(), exist_ok=True)
+    with open(_state_path() + '.tmp', 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(_state_path() + '.tmp', _state_path())
+
+def output_hash(output) -> str:
+    """Content hash of a stage output"""
+    if output is None:
+        return 'none'
+    if isinstance(output, pd.DataFrame):
+        return cache.df_hash(output)
+    return hashlib.sha256(pickle.dumps(output)).hexdigest()
+
+def fingerprint(name:str, input_hashes:list, config=None) -> str:
+    """Fingerprint of a stage run: its name, input hashes
+    and config"""
+    config = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(
+        '|'.join([name, config] + input_hashes).encode()).hexdigest()
+
+def _validate(stages:dict) -> None:
+    seen = set()
+    for name, spec in stages.items():
+        for dep in spec.get('deps', []):
+            if dep not in seen:
+                raise ValueError(f'{name} depends on {dep}, '
+                                 'which is not a previous stage')
+        seen.add(name)
+
+def run(stages:dict, 
+        from_stage:str=None, 
+        only:str=None, 
+        force:bool=False
+        ) -> dict:
+    """Runs the stages of a pipeline, skipping the ones whose 
+    inputs did not change since their last successful run.
+
+    Args:
+        stages (dict): The pipeline (see module docstring)
+        from_stage (str, optional): Runs this stage and every
+        following one. Previous stages are taken from the cache.
+        only (str, optional): Runs only this stage, taking its
+        dependencies from the cache.
+        force (bool): Runs every selected stage even if its 
+        inputs did not change, and does not resume a failed run.
+        Defaults to False.
+
+    Returns:
+        A dict with the output of every stage run or needed
+    """
+    _validate(stages)
+    for name in (from_stage, only):
+        if name is not None and name not in stages:
+            raise ValueError(f'Unknown stage {name}: {list(stages)}')
+    
+    names = list(stages)
+    state = _load_state()
+    hashes = {}
+    outputs = {}
+    
+    def load(name):
+        # Cached output of a stage, read only when needed
+        if name not in outputs:
+            entry = state.get(name)
+            if entry is None or not os.path.exists(entry['path']):
+                raise RuntimeError(f'No cached output for stage {name}, '
+                                   'run it first')
+            outputs[name] = pd.read_pickle(entry['path'])
+        return outputs[name]
+    
+    start = names.index(from_stage or only) if (from_stage or only) else 0
+    
+    # Stage the last run failed at, if resuming it
+    resume = state.get(FAILED)
+    if force or from_stage or only or resume not in stages:
+        resume = None
+    elif resume is not None:
+        log.info(f'Resuming the failed run from stage {resume}')
+    for position, name in enumerate(names):
+        spec = stages[name]
+        deps = spec.get('deps', [])
+        entry = state.get(name)
+        
+        if only and position > start:
+            break
+        if position < start:
+            # Not selected: taken from the cache when needed
+            hashes[name] = entry['output_hash'] if entry else None
+            continue
+        
+        missing = [dep for dep in deps if hashes.get(dep) is None]
+        if missing:
+            raise RuntimeError(f'Stage {name} needs {missing}, '
+                               'which were never run')
+        stage_fp = fingerprint(name, [hashes[dep] for dep in deps],
+                               spec.get('config'))
+        selected = (force or from_stage is not None or only is not None
+                    or name == resume)
+        
+        if (resume and position < names.index(resume) 
+                and spec.get('always') and entry 
+                and os.path.exists(entry['path'])):
+            log.info(f'Stage {name} taken from the failed run')
+            hashes[name] = entry['output_hash']
+            continue
+        
+        if (not selected and not spec.get('always') and entry 
+                and entry['fingerprint'] == stage_fp 
+                and os.path.exists(entry['path'])):
+            log.info(f'Stage {name} skipped, inputs and config unchanged')
+            hashes[name] = entry['output_hash']
+            continue
+        
+        log.info(f'Stage {name} running')
+        try:
+            output = spec['func'](*[load(dep) for dep in deps])
+        except (Exception, SystemExit):
+            log.error(f'Stage {name} failed, rerun to resume from it')
+            state[FAILED] = name
+            _save_state(state)
+            raise
+        
+        # Output cached on disk and stage recorded as done
+        outputs[name] = output
+        hashes[name] = output_hash(output)
+        path = os.path.join(_stages_dir(), f'{name}.pkl')
+        os.makedirs(_stages_dir(), exist_ok=True)
+        pd.to_pickle(output, path)
+        state[name] = {'fingerprint': stage_fp,
+                       'output_hash': hashes[name],
+                       'path': path}
+        if state.get(FAILED) == name:
+            del state[FAILED]
+        _save_state(state)
+        log.info(f'Stage {name} done')
+    
+    return outputs
@@ -0,0 +1,183 @@
+"""This module keeps an append-only manifest of the csv snapshots
+saved for each dataset category (csv/<category>/manifest.jsonl),
+so the latest snapshot is found without scanning the csv folders.
+It also hands dataframes already loaded in memory over to later
+steps of the same process, avoiding re-parsing their csv files,
+and writes/reads optional columnar copies of the snapshots
+(parquet or feather, requires pyarrow)"""
+
+from components.logs_config import log, log_settings
+import datetime
+import json
+import os
+import threading
+import pandas as pd
+
+MANIFEST_NAME = 'manifest.jsonl'
+COLUMNAR_FORMATS = ('parquet', 'feather')
+
+# Manifest appends and in-process handoff are shared between threads
+_LOCK = threading.Lock()
+_HANDOFF = {}
+
+# Configuring loggings
+log_settings()
+
+def manifest_path(category:str) -> str:
+    """Returns the manifest path of a category"""
+    return os.path.join(os.getcwd(), 'csv', category, MANIFEST_NAME)
+
+def record(category:str, 
+           path:str, 
+           rows:int, 
+           digest:str, 
+           columnar:str=None
+           ) -> dict:
+    """Appends a snapshot to the manifest of its category.
+
+    Args:
+        category (str): Dataset category, e.g. 'salas_de_cine'
+        path (str): Path of the saved snapshot file
+        rows (int): Number of rows saved
+        digest (str): Content hash of the saved dataframe
+        columnar (str, optional): Path of its columnar copy
+
+    Returns:
+        The manifest entry (dict)
+    """
+    entry = {'path': path,
+             'timestamp': datetime.datetime.now().isoformat(),
+             'rows': rows,
+             'hash': digest}
+    if columnar:
+        entry['columnar'] = columnar
+    with _LOCK:
+        with open(manifest_path(category), 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+    return entry
+
+def latest(category:str) -> dict:
+    """Returns the last manifest entry of a category, reading 
+    only the end of the manifest file. None if there is no manifest.
+
+    Args:
+        category (str): Dataset category, e.g. 'salas_de_cine'
+
+    Returns:
+        A dict with 'path', 'timestamp', 'rows' and 'hash' keys
+    """
+    path = manifest_path(category)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        # Read backwards until the last complete line is found
+        size = 1024
+        while True:
+            start = max(0, end - size)
+            file.seek(start)
+            lines = file.read(end - start).rstrip(b'\n').split(b'\n')
+            if len(lines) > 1 or start == 0:
+                break
+            size *= 2
+    return json.loads(lines[-1]) if lines[-1] else None
+
+def _arrow_safe(df:pd.DataFrame) -> pd.DataFrame:
+    """Casts object columns mixing value types (e.g. numbers and
+    empty strings) to strings, which arrow cannot store otherwise.
+    Typed columns are kept as they are."""
+    mixed = [col for col in df.columns[df.dtypes == object]
+             if pd.api.types.infer_dtype(df[col], skipna=True) 
+             in ('mixed', 'mixed-integer')]
+    if not mixed:
+        return df
+    return df.astype({col: 'string' for col in mixed})
+
+def write_columnar(df:pd.DataFrame, 
+                   csv_path:str, 
+                   fmt:str='parquet', 
+                   compression:str='zstd'
+                   ) -> str:
+    """Saves a compressed columnar copy of a snapshot next to its 
+    csv file, keeping column types in the file schema.
+
+    Args:
+        df (pandas.DataFrame)
+        csv_path (str): Path of the csv snapshot
+        fmt (str): 'parquet' or 'feather'. Defaults to 'parquet'
+        compression (str): Defaults to 'zstd'
+
+    Returns:
+        The path of the columnar file
+    """
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError(f'{fmt} is not one of {COLUMNAR_FORMATS}')
+    path = os.path.splitext(csv_path)[0] + '.' + fmt
+    df = _arrow_safe(df.reset_index(drop=True))
+    if fmt == 'parquet':
+        df.to_parquet(path, compression=compression, index=False)
+    else:
+        df.to_feather(path, compression=compression)
+    return path
+
+def _match_columns(names:list, columns:list) -> list:
+    """Returns the names matching columns, ignoring case"""
+    wanted = {col.lower() for col in columns}
+    return [name for name in names if name.lower() in wanted]
+
+def read_columnar(path:str, columns:list=None) -> pd.DataFrame:
+    """Reads a columnar snapshot, memory mapping the file and
+    loading only the selected columns.
+
+    Args:
+        path (str): Path of a parquet or feather file
+        columns (list, optional): Columns to load, case insensitive.
+        Defaults to all columns.
+
+    Returns:
+        A pandas.DataFrame
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        if columns is not None:
+            columns = _match_columns(pq.read_schema(path).names, columns)
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    else:
+        import pyarrow.feather as feather
+        import pyarrow.ipc as ipc
+        if columns is not None:
+            with ipc.open_file(path) as reader:
+                columns = _match_columns(reader.schema.names, columns)
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+def select_columns(df:pd.DataFrame, columns:list=None) -> pd.DataFrame:
+    """Subsets a dataframe to columns, ignoring case"""
+    if columns is None:
+        return df
+    return df[_match_columns(list(df.columns), columns)]
+
+def hand_over(path:str, df:pd.DataFrame) -> None:
+    """Keeps a dataframe saved in path, so the next take() of
+    that path returns it without reading the file.
+
+    Args:
+        path (str): Path of the saved snapshot file
+        df (pandas.DataFrame)
+    """
+    with _LOCK:
+        _HANDOFF[path] = df
+
+def take(path:str) -> pd.DataFrame:
+    """Returns (and releases) the dataframe handed over for path,
+    or None if there is none.
+
+    Args:
+        path (str): Path of the saved snapshot file
+
+    Returns:
+        A pandas.DataFrame or None
+    """
+    with _LOCK:
+        return _HANDOFF.pop(path, None)
@@ -1,34 +1,217 @@
+"""Command line entry point of the pipeline.
+
+    python script.py                  # run: load and query (as usual)
+    python script.py ingest           # download datasets only
+    python script.py load             # load tables from the last ingest
+    python script.py query [file.sql] # query only
+
+Components are imported by the subcommands that need them, so a
+query does not load the download and processing modules (nor their
+settings)."""
+
+import argparse
+import functools
 import os
-import components.downloader as dw
-import components.dataframe_processor as proc
-import components.dbconnector as con
-    
-# Download datasets, save to csv and 
-# concatenate them into one pandas dataframe
-df1 = dw.download_datasets()
-
-# Create a new postgresql database
-con.create_database()
-
-# Create 'sitios' table in db from pandas dataframe
-con.df_to_dbtable(df1, table='sitios')
-
-# Create 'totales' table in db from previous pandas dataframe
-df2 = proc.totales(df1)
-con.df_to_dbtable(df2, table='totales')
-
-# Create 'cines' table in db from last saved csv file
-raw_df3 = proc.csv_to_df(category='salas_de_cine')
-df3 = proc.cines(raw_df3)
-con.df_to_dbtable(df3, table='cines')
-
-# ADITIONAL: database query with sql file
-sqlfile_path = os.path.join(os.getcwd(),
-                            'sql',
-                            'select_from_where.sql')
-
-query = con.sql_file_exec(path=sqlfile_path, 
-                          table='cines', 
-                          condition='butacas>10000'
-                          )
-print(query)
+import sys
+
+# Default query of 'run' and 'query' subcommands
+QUERY_FILE = os.path.join(os.getcwd(), 'sql', 'select_from_where.sql')
+QUERY_PARAMS = {'table': 'cines', 'condition': 'butacas>10000'}
+
+COMMANDS = ['run', 'ingest', 'load', 'query']
+
+def pipeline() -> dict:
+    """Returns the pipeline stages, in execution order
+    (see components/runner.py)"""
+    import components.downloader as dw
+    import components.dataframe_processor as proc
+    import components.dbconnector as con
+    import components.dedup as dedup
+
+    def load_sitios(df1, _):
+        # Create 'sitios' table in db from pandas dataframe
+        con.df_to_dbtable(df1, table='sitios',
+                          method=con.SITIOS_LOAD_METHOD)
+
+    def load_totales(df2, _):
+        # Create 'totales' table in db from previous pandas dataframe
+        con.df_to_dbtable(df2, table='totales')
+
+    def cines_source(_):
+        # Last saved csv file of 'Salas de cine'
+        return proc.csv_to_df(category='salas_de_cine',
+                              columns=proc.CINES_COLUMNS)
+
+    def load_cines(df3, _):
+        # Create 'cines' table in db from last saved csv file
+        con.df_to_dbtable(df3, table='cines')
+
+    def load_matview(view, df, _):
+        # Load view source table and refresh the view in db
+        con.df_to_matview(df, view=view)
+
+    def table_config(table, method=con.LOAD_METHOD):
+        # Settings a loaded table depends on, besides its data
+        return {'method': method,
+                'indexes': con.TABLE_INDEXES.get(table),
+                'cluster': con.CLUSTER_TABLES,
+                'upsert_keys': con.UPSERT_KEYS.get(table)}
+
+    stages = {
+        # Download datasets, save to csv and
+        # concatenate them into one pandas dataframe
+        'download': {'func': dw.download_datasets, 'always': True},
+        # Remove sites repeated within or across datasets
+        'deduplicate': {'func': dedup.deduplicate, 'deps': ['download'],
+                        'config': {'deduplicate': dedup.DEDUPLICATE,
+                                   'report': dedup.DEDUP_REPORT}},
+        # Create a new postgresql database
+        'create_database': {'func': con.create_database, 'always': True},
+        'load_sitios': {'func': load_sitios,
+                        'deps': ['deduplicate', 'create_database'],
+                        'config': table_config('sitios',
+                                               con.SITIOS_LOAD_METHOD)},
+        'totales': {'func': proc.totales, 'deps': ['deduplicate'],
+                    'config': {'aggregation': con.AGGREGATION}},
+        'load_totales': {'func': load_totales,
+                         'deps': ['totales', 'create_database'],
+                         'config': table_config('totales')},
+        'cines_source': {'func': cines_source, 'deps': ['download']},
+        'cines': {'func': proc.cines, 'deps': ['cines_source'],
+                  'config': {'aggregation': con.AGGREGATION}},
+        'load_cines': {'func': load_cines,
+                       'deps': ['cines', 'create_database'],
+                       'config': table_config('cines')},
+    }
+
+    if con.AGGREGATION == 'database':
+        # totales and cines as materialized views, aggregated
+        # in the database from their source tables
+        for view, source in (('totales', 'deduplicate'),
+                             ('cines', 'cines_source')):
+            del stages[f'load_{view}']
+            stages[view] = {'func': functools.partial(load_matview, view),
+                            'deps': [source, 'create_database'],
+                            'config': {'aggregation': con.AGGREGATION,
+                                       'view': con.MATERIALIZED_VIEWS[view],
+                                       **table_config(view)}}
+
+    if not dedup.DEDUPLICATE:
+        # Sites loaded and counted as downloaded
+        stages['deduplicate']['func'] = lambda df1: df1
+    return stages
+
+def _key_values(pairs:list) -> dict:
+    """Parses key=value command line arguments"""
+    return dict(pair.split('=', 1) for pair in pairs or [])
+
+def ingest(args) -> None:
+    """Downloads the datasets, saving them for a later load"""
+    import components.runner as runner
+    runner.run(pipeline(), only='download')
+
+def load(args) -> None:
+    """Loads the tables from the last ingested datasets"""
+    import components.runner as runner
+    import components.dbconnector as con
+    stages = pipeline()
+    # Every stage after the download, unless stages are selected
+    from_stage = args.from_stage
+    if from_stage is None and args.only is None:
+        from_stage = list(stages)[1]
+    runner.run(stages,
+               from_stage=from_stage,
+               only=args.only,
+               force=args.force)
+
+    # Release pooled database connections
+    con.dispose()
+
+def query(args) -> None:
+    """Executes a sql file and prints its result"""
+    import components.dbconnector as con
+    params = _key_values(args.param)
+    if args.path == QUERY_FILE and not params:
+        params = QUERY_PARAMS
+    result = con.sql_file_exec(path=args.path,
+                               bind_params=_key_values(args.bind),
+                               **params)
+    print(result)
+
+    # Release pooled database connections
+    con.dispose()
+
+def run(args) -> None:
+    """Runs the whole pipeline and the default query"""
+    import components.downloader as dw
+    import components.runner as runner
+
+    if dw.CHUNK_SIZE:
+        # Download, normalize and load every dataset in chunks,
+        # with bounded memory (see CHUNK_SIZE setting)
+        if args.from_stage or args.only:
+            sys.exit('--from-stage and --only need the staged '
+                     'pipeline, set CHUNK_SIZE = 0')
+        import components.chunked as chunked
+        chunked.run()
+
+    else:
+        # Unchanged stages are skipped and failed runs resume
+        # from the failed stage
+        runner.run(pipeline(),
+                   from_stage=args.from_stage,
+                   only=args.only,
+                   force=args.force)
+
+    # ADITIONAL: database query with sql file
+    args.path, args.param, args.bind = QUERY_FILE, None, None
+    query(args)
+
+def main(argv:list=None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Stage selection of 'run' and 'load'
+    stages = argparse.ArgumentParser(add_help=False)
+    stages.add_argument('--from-stage',
+                        help='run this stage and every following one')
+    stages.add_argument('--only',
+                        help='run only this stage')
+    stages.add_argument('--force', action='store_true',
+                        help='run stages even if their inputs did not '
+                             'change, also the ones a failed run resumes '
+                             'from the cache')
+
+    subparsers.add_parser('run', parents=[stages], help=run.__doc__
+                          ).set_defaults(func=run)
+    subparsers.add_parser('ingest', help=ingest.__doc__
+                          ).set_defaults(func=ingest)
+    subparsers.add_parser('load', parents=[stages], help=load.__doc__
+                          ).set_defaults(func=load)
+    query_parser = subparsers.add_parser('query', help=query.__doc__)
+    query_parser.add_argument('path', nargs='?', default=QUERY_FILE,
+                              help='sql file (default: %(default)s)')
+    query_parser.add_argument('-p', '--param', action='append',
+                              metavar='KEY=VALUE',
+                              help='{key} template value of the file')
+    query_parser.add_argument('-b', '--bind', action='append',
+                              metavar='KEY=VALUE',
+                              help=':key bound parameter value')
+    query_parser.set_defaults(func=query)
+
+    # No subcommand runs the whole pipeline, as before
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+    args.func(args)
+
+    if args.command != 'query':
+        # Per stage durations, rows, bytes and memory of this run
+        import components.metrics as metrics
+        metrics.log_summary()
+
+if __name__ == '__main__':
+    main()
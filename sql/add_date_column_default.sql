@@ -0,0 +1,2 @@
+ALTER TABLE {tab}
+    ADD COLUMN {col} DATE DEFAULT current_date;
\ No newline at end of file
@@ -0,0 +1 @@
+ANALYZE {tab};
\ No newline at end of file
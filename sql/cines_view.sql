@@ -0,0 +1,22 @@
+CREATE MATERIALIZED VIEW {view} AS
+WITH cleaned AS (
+    SELECT provincia,
+           CASE WHEN btrim(pantallas) ~ '^[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?$'
+                THEN btrim(pantallas)::numeric END AS pantallas,
+           CASE WHEN btrim(butacas) ~ '^[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?$'
+                THEN btrim(butacas)::numeric END AS butacas,
+           NULLIF(NULLIF(NULLIF(NULLIF(
+               lower(regexp_replace(espacio_incaa, '^\s+|\s+$', '', 'g')),
+               's/d'), ''), '"'), '0') AS espacio_incaa
+    FROM {source}
+    WHERE provincia IS NOT NULL
+)
+SELECT row_number() OVER (ORDER BY provincia COLLATE "C") - 1 AS "index",
+       provincia,
+       trunc(COALESCE(SUM(pantallas), 0))::bigint AS pantallas,
+       trunc(COALESCE(SUM(butacas), 0))::bigint AS butacas,
+       COUNT(espacio_incaa) AS espacio_incaa,
+       current_date AS fecha_de_carga
+FROM cleaned
+GROUP BY provincia
+ORDER BY "index";
@@ -0,0 +1 @@
+CLUSTER {tab} USING {name};
\ No newline at end of file
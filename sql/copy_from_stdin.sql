@@ -0,0 +1 @@
+COPY {tab} ({cols}) FROM STDIN WITH (FORMAT csv)
\ No newline at end of file
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS {name}
+    ON {tab} ({cols});
\ No newline at end of file
@@ -0,0 +1,2 @@
+CREATE UNIQUE INDEX IF NOT EXISTS {view}_index
+    ON {view} ("index");
\ No newline at end of file
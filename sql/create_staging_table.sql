@@ -0,0 +1,2 @@
+CREATE TEMP TABLE {stage} ON COMMIT DROP
+    AS SELECT * FROM {tab} WITH NO DATA;
\ No newline at end of file
@@ -0,0 +1,2 @@
+CREATE UNIQUE INDEX IF NOT EXISTS {tab}_upsert_keys
+    ON {tab} ({cols});
\ No newline at end of file
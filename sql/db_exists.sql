@@ -1 +1 @@
-SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{db_name}';
\ No newline at end of file
+SELECT oid FROM pg_catalog.pg_database WHERE datname = :db_name;
\ No newline at end of file
@@ -0,0 +1,3 @@
+DELETE FROM {tab} AS t
+    USING {stage} AS s
+    WHERE {match};
\ No newline at end of file
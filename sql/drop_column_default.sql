@@ -0,0 +1,2 @@
+ALTER TABLE {tab}
+    ALTER COLUMN {col} DROP DEFAULT;
\ No newline at end of file
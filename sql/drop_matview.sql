@@ -0,0 +1 @@
+DROP MATERIALIZED VIEW {view};
\ No newline at end of file
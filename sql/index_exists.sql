@@ -0,0 +1,2 @@
+SELECT 1 FROM pg_catalog.pg_indexes 
+    WHERE tablename = :tab AND indexname = :name;
\ No newline at end of file
@@ -0,0 +1 @@
+SELECT 1 FROM pg_catalog.pg_matviews WHERE matviewname = :view;
\ No newline at end of file
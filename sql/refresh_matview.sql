@@ -0,0 +1 @@
+REFRESH MATERIALIZED VIEW CONCURRENTLY {view};
\ No newline at end of file
@@ -0,0 +1,40 @@
+CREATE MATERIALIZED VIEW {view} AS
+WITH categoria AS (
+    SELECT categoria AS valor, COUNT(*) AS registros_totales,
+           MIN("index") AS first_row
+    FROM {source}
+    WHERE categoria IS NOT NULL
+    GROUP BY categoria
+), fuente AS (
+    SELECT fuente AS valor, COUNT(*) AS registros_totales,
+           MIN("index") AS first_row
+    FROM {source}
+    WHERE fuente IS NOT NULL
+    GROUP BY fuente
+), provincia_categoria AS (
+    SELECT provincia, categoria, COUNT(*) AS registros_totales
+    FROM {source}
+    GROUP BY provincia, categoria
+), tallies AS (
+    SELECT 1 AS part, 'categoria' AS columna, valor, registros_totales,
+           row_number() OVER (ORDER BY registros_totales DESC, 
+                                       first_row) AS position
+    FROM categoria
+    UNION ALL
+    SELECT 2, 'fuente', valor, registros_totales,
+           row_number() OVER (ORDER BY registros_totales DESC, 
+                                       first_row)
+    FROM fuente
+    UNION ALL
+    SELECT 3, 'provincia_categoria', 
+           COALESCE(provincia, 'nan') || ' - ' || COALESCE(categoria, 'nan'),
+           registros_totales,
+           row_number() OVER (ORDER BY provincia COLLATE "C" NULLS LAST, 
+                                       categoria COLLATE "C" NULLS LAST)
+    FROM provincia_categoria
+)
+SELECT row_number() OVER (ORDER BY part, position) - 1 AS "index",
+       columna, valor, registros_totales, 
+       current_date AS fecha_de_carga
+FROM tallies
+ORDER BY "index";
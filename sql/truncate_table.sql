@@ -0,0 +1 @@
+TRUNCATE {tab};
\ No newline at end of file
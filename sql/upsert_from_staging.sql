@@ -0,0 +1,7 @@
+INSERT INTO {tab} ("index", {cols}, fecha_de_carga)
+    SELECT (SELECT COALESCE(MAX("index"), -1) FROM {tab}) 
+               + row_number() OVER (),
+           {cols}, current_date
+    FROM {stage}
+ON CONFLICT ({key}) DO UPDATE
+    SET {updates};
\ No newline at end of file